@@ -1,21 +1,23 @@
 import csv
-import json
+
+from ratings_store import RatingsStore
 
 
 def main():
-    ratings = json.load(open("ratings.json"))
+    store = RatingsStore()
 
     with open('manual-ratings-9-2024.csv', 'r') as file:
         reader = csv.DictReader(file)
+        ratings = []
         for r in reader:
-            if r["id"] not in ratings:
-                ratings[r["id"]] = {}
-            ratings[r["id"]]["tivvit"] = {"like": r['tivvit like'], "veto": r["tivvit veto"]}
-            ratings[r["id"]]["simon"] = r['simon']
-            ratings[r["id"]]["eve"] = r['eve']
-            ratings[r["id"]]["tomas"] = r['tomas']
+            ratings.append((r["id"], "tivvit", {"like": r['tivvit like'], "veto": r["tivvit veto"]}))
+            ratings.append((r["id"], "simon", r['simon']))
+            ratings.append((r["id"], "eve", r['eve']))
+            ratings.append((r["id"], "tomas", r['tomas']))
+    store.put_many(ratings)
 
-    json.dump(ratings, open("ratings.json", "w"))
+    store.export()
+    store.close()
 
 
 if __name__ == '__main__':
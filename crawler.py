@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, List, Mapping, NamedTuple, Optional, Set, TextIO, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from download import MAX_REGION_ID, SEARCH_PATH, parse_links, property_links, search_form
+from html_cache import HtmlCache
+from journal import CrawlJournal
+from metrics import METRICS
+from page_parser import DEFAULT_BACKEND, parse_line, review_page_links
+
+RETRIES = 4
+BACKOFF = 1.0  # seconds, doubled after every failed attempt
+TIMEOUT = 60  # seconds per request
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+QUEUE_SIZE = 64  # fetched pages waiting for a parser and parsed records waiting for the writer
+
+
+class Response(NamedTuple):
+    status: int
+    headers: Mapping[str, str]
+    body: bytes
+    encoding: str
+    text: str
+
+
+class TokenBucket:
+    """
+    allow `rate` requests per second with bursts of up to `burst` requests
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Crawler:
+    def __init__(self, session: aiohttp.ClientSession, rps: float, retries: int = RETRIES):
+        self.session = session
+        self.rps = rps
+        self.retries = retries
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.pages = 0
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rps)
+        return self.buckets[host]
+
+    async def request(self, method: str, url: str, **kwargs) -> Response:
+        for attempt in range(self.retries + 1):
+            await self.bucket(url).acquire()
+            try:
+                start = time.perf_counter()
+                async with self.session.request(method, url, **kwargs) as response:
+                    if response.status in RETRY_STATUSES:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                          status=response.status, message=response.reason)
+                    response.raise_for_status()
+                    body = await response.read()
+                    METRICS.add("fetch", time.perf_counter() - start)
+                    self.pages += 1
+                    METRICS.count("fetched_bytes", len(body))
+                    encoding = response.get_encoding()
+                    return Response(response.status, response.headers, body, encoding,
+                                    body.decode(encoding, errors="replace"))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries or (
+                        isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUSES):
+                    raise
+                METRICS.count("fetch_retries")
+                delay = BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                logging.warning(f"{method} {url} failed ({e!r}), retry {attempt + 1}/{self.retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def links_in_region(self, base_url: str, region: int, journal: CrawlJournal) -> Set[str]:
+        urls = journal.region(region)
+        if urls is not None:
+            return urls
+        try:
+            response = await self.request("POST", base_url + SEARCH_PATH, data=search_form(region))
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logging.exception(f"failed to search region {region}")
+            return set()
+        urls = property_links(parse_links(response.text))
+        logging.info(f"found {len(urls)} at {region}")
+        journal.record_region(region, urls)
+        return urls
+
+    async def urls(self, base_url: str, journal: CrawlJournal) -> Set[str]:
+        property_urls = set()
+        for links in await asyncio.gather(*(self.links_in_region(base_url, region, journal)
+                                            for region in range(1, MAX_REGION_ID))):
+            property_urls |= links
+        logging.info(f"total found {len(property_urls)}")
+        return property_urls
+
+    async def review_pages(self, url: str, html: str, cache: Optional[HtmlCache]) -> List[str]:
+        """
+        fetch all review listing pages of a property at once, any failure fails the whole property
+        """
+        links = review_page_links(url, html)
+        responses = await asyncio.gather(*(self.request("GET", link) for link in links))
+        if cache is not None:
+            for link, response in zip(links, responses):
+                cache.put(link, response.body, response.encoding)
+        return [response.text for response in responses]
+
+
+async def fetch_worker(crawler: Crawler, urls: asyncio.Queue, pages: asyncio.Queue, journal: CrawlJournal,
+                       cache: Optional[HtmlCache]):
+    while True:
+        url = await urls.get()
+        try:
+            response = await crawler.request("GET", url, headers=journal.conditional_headers(url))
+            if cache is not None and response.status == 200:
+                cache.put(url, response.body, response.encoding)
+            if journal.changed(url, response.status, response.body):
+                reviews = await crawler.review_pages(url, response.text, cache)
+                # blocks when the parsers fall behind
+                await pages.put((url, response, reviews))
+            else:
+                journal.record_page(url, response.status, response.headers, response.body, False)
+        except Exception:
+            logging.exception(f"failed to download {url}")
+        finally:
+            urls.task_done()
+
+
+def parse_timed(url: str, html: str, backend: str, reviews: List[str]) -> Tuple[str, float]:
+    # timed where it runs, the wait for a pool process and for the event loop is not parsing
+    start = time.perf_counter()
+    line = parse_line(url, html, backend, reviews)
+    return line, time.perf_counter() - start
+
+
+async def parse_worker(pages: asyncio.Queue, records: asyncio.Queue, pool: Optional[Executor], backend: str):
+    loop = asyncio.get_running_loop()
+    while True:
+        url, response, reviews = await pages.get()
+        try:
+            if pool is None:
+                line, seconds = parse_timed(url, response.text, backend, reviews)
+            else:
+                line, seconds = await loop.run_in_executor(pool, parse_timed, url, response.text, backend, reviews)
+            METRICS.add("parse", seconds)
+            await records.put((url, response, line))
+        except Exception:
+            logging.exception(f"failed to parse {url}")
+        finally:
+            pages.task_done()
+
+
+async def writer(records: asyncio.Queue, out: TextIO, journal: CrawlJournal):
+    while True:
+        url, response, line = await records.get()
+        try:
+            with METRICS.stage("write"):
+                out.write(line)
+                out.flush()
+                journal.record_page(url, response.status, response.headers, response.body, True)
+        finally:
+            records.task_done()
+
+
+async def crawl_async(out: TextIO, base_url: str, concurrency: int, rps: float, journal: CrawlJournal,
+                      cache: Optional[HtmlCache], backend: str, pool: Optional[Executor], parsers: int) -> int:
+    """
+    pipeline of `concurrency` fetchers -> bounded queue -> `parsers` parse tasks (optionally on a process pool)
+    -> single writer, the bounded queues keep the memory flat when any stage falls behind
+    """
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        crawler = Crawler(session, rps)
+        urls = asyncio.Queue()
+        pages = asyncio.Queue(maxsize=QUEUE_SIZE)
+        records = asyncio.Queue(maxsize=QUEUE_SIZE)
+        for url in await crawler.urls(base_url, journal):
+            if url not in journal.done:
+                urls.put_nowait(url)
+        tasks = [asyncio.create_task(fetch_worker(crawler, urls, pages, journal, cache)) for _ in range(concurrency)]
+        tasks += [asyncio.create_task(parse_worker(pages, records, pool, backend)) for _ in range(parsers)]
+        tasks.append(asyncio.create_task(writer(records, out, journal)))
+        joined = asyncio.create_task(join_all(urls, pages, records))
+        try:
+            # the workers only end by failing (e.g. the writer on a full disk), the tasks feeding a failed one
+            # would wait on its full queue forever
+            await asyncio.wait([joined, *tasks], return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task.done():
+                    task.result()
+        finally:
+            joined.cancel()
+            for task in tasks:
+                task.cancel()
+        return crawler.pages
+
+
+async def join_all(*queues: asyncio.Queue):
+    for queue in queues:
+        await queue.join()
+
+
+def crawl(out: TextIO, base_url: str, concurrency: int, rps: float, journal: CrawlJournal,
+          cache: Optional[HtmlCache] = None, backend: str = DEFAULT_BACKEND, parse_workers: int = 0) -> int:
+    """
+    crawl all regions and properties with up to `concurrency` requests in flight, returns number of fetched pages
+    """
+    if parse_workers <= 0:
+        return asyncio.run(crawl_async(out, base_url, concurrency, rps, journal, cache, backend, None, 1))
+    with ProcessPoolExecutor(parse_workers) as pool:
+        # two parse tasks per process so a worker never waits for the event loop
+        return asyncio.run(crawl_async(out, base_url, concurrency, rps, journal, cache, backend, pool,
+                                       parse_workers * 2))
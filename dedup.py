@@ -0,0 +1,117 @@
+"""
+near-duplicate listings (the same chalet listed under several ids or areas) by MinHash signatures
+of the page text, name and GPS, matched with locality-sensitive hashing in a single pass
+"""
+import re
+import zlib
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# signature length, bands x rows, a pair becomes a candidate when all rows of any band are equal
+BANDS = 10
+ROWS = 5
+NUM_PERM = BANDS * ROWS
+# estimated jaccard similarity of the shingle sets from which a candidate is a duplicate
+SIMILARITY = 0.75
+# words in a text shingle
+SHINGLE_WORDS = 3
+# GPS rounded to about a kilometre, the same chalet is often placed slightly differently
+GPS_DIGITS = 2
+
+# multiply-shift hash functions ((a * x + b) mod 2^64) >> 32 with fixed seeds and odd a
+hash_seeds = np.random.default_rng(20240101)
+HASH_A = hash_seeds.integers(0, 1 << 64, NUM_PERM, dtype=np.uint64, endpoint=False)[:, None] | np.uint64(1)
+HASH_B = hash_seeds.integers(0, 1 << 64, NUM_PERM, dtype=np.uint64, endpoint=False)[:, None]
+# multipliers combining word hashes into a shingle hash
+SHINGLE_MULTIPLIERS = [np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F), np.uint64(1)]
+
+word_extractor = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=1 << 16)
+def token_hash(token: str) -> int:
+    # crc32 is stable across processes unlike hash(), so workers compute the same signatures
+    return zlib.crc32(token.encode("utf-8"))
+
+
+def signature(prop: Dict[str, Any]) -> Optional[np.ndarray]:
+    """
+    MinHash of the word shingles of the text plus the name words and the rounded GPS position,
+    None for a record without any of them
+    """
+    words = (prop.get("text") or "").lower().split()
+    hashes = np.fromiter(map(token_hash, words), dtype=np.uint64, count=len(words))
+    if len(hashes) >= SHINGLE_WORDS:
+        n = len(hashes) - SHINGLE_WORDS + 1
+        shingles = sum(hashes[i:i + n] * m for i, m in enumerate(SHINGLE_MULTIPLIERS))
+    else:
+        shingles = hashes
+    extra = [f"name:{word}" for word in word_extractor.findall((prop.get("name") or "").lower())]
+    gps = prop.get("GPS")
+    if gps:
+        try:
+            extra.append(f"gps:{float(gps['N']):.{GPS_DIGITS}f},{float(gps['E']):.{GPS_DIGITS}f}")
+        except (KeyError, TypeError, ValueError):
+            pass
+    shingles = np.concatenate([shingles, np.fromiter(map(token_hash, extra), dtype=np.uint64, count=len(extra))])
+    if not len(shingles):
+        return None
+    return ((HASH_A * shingles + HASH_B) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+
+class DuplicateIndex:
+    """
+    LSH buckets of all signatures added so far, a record is a duplicate of the earliest indexed record it matches,
+    so the first listing of a cluster is its canonical one and duplicates always point back in input order
+    """
+
+    def __init__(self):
+        self.signatures = np.empty((1024, NUM_PERM), dtype=np.uint32)
+        self.canonical: List[str] = []  # canonical id of every indexed record
+        # band key -> record index, or a list of them when more records share the bucket
+        self.buckets: List[Dict[int, Any]] = [{} for _ in range(BANDS)]
+
+    def __len__(self):
+        return len(self.canonical)
+
+    def add(self, record_id: str, sig: Optional[np.ndarray]) -> Optional[str]:
+        """
+        index a record, returns the canonical id of the cluster when it duplicates an earlier record
+        """
+        if sig is None:
+            return None
+        keys = [hash(sig[band * ROWS:(band + 1) * ROWS].tobytes()) for band in range(BANDS)]
+        candidates = set()
+        for buckets, key in zip(self.buckets, keys):
+            found = buckets.get(key)
+            if isinstance(found, int):
+                candidates.add(found)
+            elif found is not None:
+                candidates.update(found)
+        canonical = None
+        if candidates:
+            candidates = np.array(sorted(candidates))
+            similar = np.flatnonzero((self.signatures[candidates] == sig).mean(axis=1) >= SIMILARITY)
+            if len(similar):
+                canonical = self.canonical[candidates[similar[0]]]
+
+        index = len(self.canonical)
+        if index == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.empty_like(self.signatures)])
+        self.signatures[index] = sig
+        self.canonical.append(canonical or record_id)
+        for buckets, key in zip(self.buckets, keys):
+            found = buckets.get(key)
+            if found is None:
+                buckets[key] = index
+            elif isinstance(found, int):
+                buckets[key] = [found, index]
+            else:
+                found.append(index)
+        return canonical
+
+
+def record_id(prop: Dict[str, Any]) -> str:
+    return prop.get("id") or prop.get("url")
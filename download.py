@@ -1,97 +1,234 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import requests
 from bs4 import BeautifulSoup
-from typing import Set, Dict, Any
+from typing import Set, Dict, Any, List, Optional, TextIO
 import logging
-import re
-import json
+import time
+
+from html_cache import HtmlCache, read_page
+from journal import CrawlJournal
+from metrics import METRICS, METRICS_DIR
+from page_parser import BACKENDS, DEFAULT_BACKEND, is_review_page, parse_line, parse_property, review_page_links
+from storage import COMPRESSIONS, MANIFEST_SUFFIX, ShardedWriter, output_paths, read_lines
+from utils import bounded_map
 
+BASE_URL = "https://www.e-chalupy.cz"
+SEARCH_PATH = "/hledam/#zalozka_prehled"
 MAX_REGION_ID = 100
 
 
-def get_links_in_region(region: int, capacity: str = 18, rooms: int = 2) -> Set[str]:
+def search_form(region: int, capacity: str = 18, rooms: int = 2) -> Dict[str, str]:
+    return {"fkapacita": str(capacity),
+            "fpokoje": str(rooms),
+            "ftyp": "0",
+            "fid_oblasti": str(region),
+            "furl_okres": "0",
+            "fid_obec": "0",
+            "finternet": "",
+            "hledej_podrobne": "HLEDEJ",
+            }
+
+
+def parse_links(html: str) -> Set[str]:
     urls = set()
-    response = requests.post("https://www.e-chalupy.cz/hledam/#zalozka_prehled",
-                             data={"fkapacita": str(capacity),
-                                   "fpokoje": str(rooms),
-                                   "ftyp": "0",
-                                   "fid_oblasti": str(region),
-                                   "furl_okres": "0",
-                                   "fid_obec": "0",
-                                   "finternet": "",
-                                   "hledej_podrobne": "HLEDEJ",
-                                   })
-    logging.info(f"status {response.status_code}")
-    soup = BeautifulSoup(response.text, 'html.parser')
+    soup = BeautifulSoup(html, 'html.parser')
     results = soup.find(id="vysledky_hledani")
     if not results:
         return urls
     for prop in results.find_all(class_="pl"):
         for link in prop.find("h3").find_all("a"):
             urls.add(link.get("href"))
+    return urls
+
+
+def property_links(urls: Set[str]) -> Set[str]:
+    # filter out regions (not ending with .php)
+    return set(filter(lambda x: x.endswith(".php"), urls))
+
+
+def get_links_in_region(region: int, capacity: str = 18, rooms: int = 2, base_url: str = BASE_URL) -> Set[str]:
+    with METRICS.stage("fetch"):
+        response = requests.post(base_url + SEARCH_PATH, data=search_form(region, capacity, rooms))
+    logging.info(f"status {response.status_code}")
+    urls = parse_links(response.text)
     logging.info(f"found {len(urls)} at {region}")
     return urls
 
 
-def get_urls() -> Set[str]:
+def get_urls(base_url: str = BASE_URL, journal: Optional[CrawlJournal] = None) -> Set[str]:
     property_urls = set()
     for region in range(1, MAX_REGION_ID):
-        # filter out regions (not ending with .php)
-        property_urls |= set(filter(lambda x: x.endswith(".php"), get_links_in_region(region)))
+        links = journal.region(region) if journal else None
+        if links is None:
+            links = property_links(get_links_in_region(region, base_url=base_url))
+            if journal:
+                journal.record_region(region, links)
+        property_urls |= links
     logging.info(f"total found {len(property_urls)}")
     return property_urls
 
 
-def clean(s: str) -> str:
-    return s.replace('\r', '').replace('\n', '')
+def get_review_pages(url: str, html: str, cache: Optional[HtmlCache] = None) -> List[str]:
+    reviews = []
+    for link in review_page_links(url, html):
+        with METRICS.stage("fetch"):
+            response = requests.get(link)
+        response.raise_for_status()
+        if cache is not None:
+            cache.put(link, response.content, response.encoding)
+        reviews.append(response.text)
+    return reviews
 
 
 def get_property_info(url: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(requests.get(url).text, 'html.parser')
-    prop = soup.find(class_="chata")
-    capacity = re.search("(?:\d*\saž\s)?(\d+)\sosob(?:\s\|\s(\d+)?)?", clean(prop.find(id="kapacita").text))
-    contact = prop.find(id="kontakty")
-    logging.info(url)
-    gps = re.search("GPS .*: (\d+.\d+)N, (\d+.\d+)E", prop.text)
-    rating_match = "Celkové hodnocení:\s+(\d+)%"
-    data = {
-        "url": url,
-        "id": prop.find(id="cislo_o").text,
-        "name": prop.find("h1").text,
-        "locality": prop.find("h2").text,
-        "capacity": capacity.group(1),
-        "rooms": capacity.group(2),
-        "icons": [i.get("alt") for i in prop.find(id="ikony").find_all()],
-        "contact_raw": clean(contact.text),
-        "contact_links": [i.get("href") for i in contact.find_all("a")],
-        "map_link": prop.find(id="vetsi_mapa").get("href"),
-        "distances": [(clean(i.find_all("td")[0].text), clean(i.find_all("td")[1].text)) for i in
-                      prop.find(id="dest").find_all("tr")] if prop.find(id="dest") else [],
-        "equipment": [j.get("alt") for i in prop.find_all(class_="prehled") for j in i.find_all("img")],
-        "ratings": [i.text for i in prop.find_all(class_="recenze")],
-        "numeric_ratings": [re.search(rating_match, i.text, re.UNICODE).group(1) for i in
-                            prop.find_all(class_="recenze") if re.search(rating_match, i.text, re.UNICODE)],
-        "place": clean(prop.find(class_="kamdal").text),
-        "pricelist": [clean(i.text) for i in prop.find(id="cenik").find_all("td")] if prop.find(id="cenik") else [],
-        "images": [(i.get("title"), i.get("href")) for i in prop.find(id="nahledy").find_all("a")],
-        "text": prop.text,
-    }
-    # TODO there are extra ratings (on the main page there is a random subset), detect it and download them all.
-    if gps:
-        data.update({
-            "GPS": {
-                "N": gps.group(1),
-                "E": gps.group(2),
-            }
-        })
-    return data
+    html = requests.get(url).text
+    return parse_property(url, html, review_pages=get_review_pages(url, html))
+
+
+def crawl_serial(out: TextIO, base_url: str, journal: CrawlJournal, cache: Optional[HtmlCache],
+                 backend: str = DEFAULT_BACKEND) -> int:
+    pages = MAX_REGION_ID - 1 - len(journal.regions)
+    for link in get_urls(base_url, journal):
+        if link in journal.done:
+            continue
+        with METRICS.stage("fetch"):
+            response = requests.get(link, headers=journal.conditional_headers(link))
+        pages += 1
+        METRICS.count("fetched_bytes", len(response.content))
+        if cache is not None and response.status_code == 200:
+            cache.put(link, response.content, response.encoding)
+        changed = journal.changed(link, response.status_code, response.content)
+        if changed:
+            reviews = get_review_pages(link, response.text, cache)
+            pages += len(reviews)
+            with METRICS.stage("parse"):
+                line = parse_line(link, response.text, backend, reviews)
+            with METRICS.stage("write"):
+                out.write(line)
+                out.flush()
+        journal.record_page(link, response.status_code, response.headers, response.content, changed)
+    return pages
+
+
+def parse_cached(root: str, entry: Dict[str, str], backend: str,
+                 review_entries: Dict[str, Dict[str, str]]) -> Optional[str]:
+    """
+    None when the page can not be parsed, the cache keeps every 200 response, also the pages without a property
+    """
+    try:
+        html = read_page(root, entry)
+        reviews = [read_page(root, review_entries[link]) for link in review_page_links(entry["url"], html)
+                   if link in review_entries]
+        return parse_line(entry["url"], html, backend, reviews)
+    except Exception:
+        logging.exception(f"failed to parse {entry['url']}")
+        return None
+
+
+def replay(out: TextIO, cache: HtmlCache, backend: str = DEFAULT_BACKEND, parse_workers: int = 0) -> int:
+    """
+    parse all cached pages again without touching the network, optionally on a pool of `parse_workers` processes
+    """
+    pages = 0
+    review_entries: Dict[str, Dict[str, Dict[str, str]]] = {}
+    for url, entry in cache.index.items():
+        if is_review_page(url):
+            review_entries.setdefault(url.split("?", 1)[0], {})[url] = entry
+    tasks = ((cache.root, entry, backend, review_entries.get(url, {})) for url, entry in cache.index.items()
+             if not is_review_page(url))
+    if parse_workers > 0:
+        # the pages are parsed in the workers, the stage is the wall time of the whole pool
+        with ProcessPoolExecutor(parse_workers) as pool, METRICS.stage("parse", 0) as timer:
+            for line in bounded_map(pool, parse_cached, tasks, parse_workers * 4):
+                if line is None:
+                    METRICS.count("parse_failed")
+                    continue
+                out.write(line)
+                pages += 1
+                timer.items += 1
+        return pages
+    for task in tasks:
+        with METRICS.stage("parse"):
+            line = parse_cached(*task)
+        if line is None:
+            METRICS.count("parse_failed")
+            continue
+        out.write(line)
+        pages += 1
+    return pages
 
 
 def main():
+    parser = argparse.ArgumentParser(description="crawl e-chalupy.cz into properties.json.gz")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="number of requests in flight (0 = serial crawl)")
+    parser.add_argument("--rps", type=float, default=10, help="max requests per second per host")
+    parser.add_argument("--base-url", default=BASE_URL, help="site to crawl (e.g. a local fixture server)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the last interrupted crawl, fetching only pages missing in the journal")
+    parser.add_argument("--incremental", metavar="PREVIOUS",
+                        help="re-crawl with conditional requests, records of unchanged pages are copied "
+                             "from the PREVIOUS output (e.g. properties.json.gz)")
+    parser.add_argument("--no-cache", action="store_true", help="do not store raw pages in the html cache")
+    parser.add_argument("--replay", action="store_true",
+                        help="only parse the pages from the html cache again, no network access")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=DEFAULT_BACKEND,
+                        help="html parser used to extract the properties")
+    parser.add_argument("--parse-workers", type=int, default=0,
+                        help="parse pages on a pool of processes (concurrent crawl and replay only)")
+    parser.add_argument("--output", default="properties.json",
+                        help="output path, the compression extension (and shard number) is appended")
+    parser.add_argument("--compression", choices=list(COMPRESSIONS), default="gzip")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="spread the output over N files listed in <output>.manifest.json")
+    parser.add_argument("--metrics", default=METRICS_DIR, help="directory of the run report and Prometheus textfile")
+    parser.add_argument("--profile", metavar="STAGE", help="cProfile a stage of this process (e.g. parse)")
+    args = parser.parse_args()
+    METRICS.profile(args.profile)
+    if args.replay and args.no_cache:
+        parser.error("--replay needs the html cache")
+    outputs = output_paths(args.output, args.compression, args.shards) + [args.output + MANIFEST_SUFFIX]
+    if args.incremental and os.path.abspath(args.incremental) in map(os.path.abspath, outputs):
+        parser.error("--incremental reads the previous output, move it away from --output first")
+
     # init logger
     logging.getLogger().setLevel(logging.INFO)
-    with open("properties.json", "w", encoding="utf-8") as f:
-        for link in get_urls():
-            f.write(json.dumps(get_property_info(link)) + "\n")
+    start = time.monotonic()
+    cache = None if args.no_cache else HtmlCache()
+    if args.replay:
+        with ShardedWriter(args.output, args.compression, args.shards) as f:
+            pages = replay(f, cache, args.backend, args.parse_workers)
+        elapsed = time.monotonic() - start
+        logging.info(f"parsed {pages} cached pages in {elapsed:.1f}s ({pages / elapsed:.2f} pages/s)")
+        METRICS.count("pages", pages)
+        METRICS.write("replay", args.metrics)
+        return
+    journal = CrawlJournal(resume=args.resume, incremental=bool(args.incremental))
+    if args.resume:
+        logging.info(f"resuming crawl {journal.crawl_id}, {len(journal.done)} pages already done")
+    with ShardedWriter(args.output, args.compression, args.shards, append=args.resume) as f:
+        if args.concurrency > 0:
+            # aiohttp is only needed for the concurrent crawl
+            from crawler import crawl
+            pages = crawl(f, args.base_url, args.concurrency, args.rps, journal, cache, args.backend,
+                          args.parse_workers)
+        else:
+            pages = crawl_serial(f, args.base_url, journal, cache, args.backend)
+        if args.incremental:
+            carried = journal.carry_unchanged(read_lines(args.incremental), f)
+            logging.info(f"{len(journal.unchanged)} pages unchanged, {carried} records carried over")
+    journal.close()
+    if cache is not None:
+        cache.close()
+    elapsed = time.monotonic() - start
+    logging.info(f"fetched {pages} pages in {elapsed:.1f}s ({pages / elapsed:.2f} pages/s), "
+                 f"{sum(f.records)} records in {f.path}")
+    METRICS.count("pages", pages)
+    METRICS.count("records", sum(f.records))
+    METRICS.write("crawl", args.metrics)
 
 
 if __name__ == '__main__':
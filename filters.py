@@ -0,0 +1,228 @@
+"""
+declarative filter rules from filters.json, evaluated as numpy masks over a batch of records or a parquet table
+"""
+import json
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence
+
+import numpy as np
+
+from geo import GeoIndex, load_regions
+from record import Property
+
+try:
+    import pyarrow
+    import pyarrow.compute
+except ImportError:
+    pyarrow = None
+
+FILTERS_PATH = "filters.json"
+
+COMPARISONS = {
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "==": np.equal,
+    "!=": np.not_equal,
+}
+# on a GPS field ({"N": .., "E": ..}), records without coordinates never match:
+# within/beyond: closer/farther than {"lat": .., "lon": .., "km": ..}, inside/outside: the polygons of a GeoJSON file
+GEO_OPERATORS = {"within", "beyond", "inside", "outside"}
+# missing: absent, null or empty, set: truthy, in: one of the values, lacks: no list item contains any of the values
+OPERATORS = set(COMPARISONS) | {"missing", "set", "in", "lacks"} | GEO_OPERATORS
+
+
+class Rule(NamedTuple):
+    reason: str
+    field: str  # dotted path into nested objects, e.g. GPS.E
+    op: str
+    value: Any
+    soft: bool  # soft rules are only reported, they do not filter the property out
+
+    @property
+    def counter(self) -> str:
+        return f"filtered_{self.reason}_soft" if self.soft else f"filtered_{self.reason}"
+
+
+def load_rules(path: str = FILTERS_PATH) -> List[Rule]:
+    """
+    rules in evaluation order, `{value}` in a reason is replaced by the rule value (e.g. small_capacity_<{value})
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    rules = []
+    for entry in config["rules"]:
+        if entry["op"] not in OPERATORS:
+            raise ValueError(f"unknown operator {entry['op']!r} in {path}, use one of {sorted(OPERATORS)}")
+        value = entry.get("value")
+        if entry["op"] in ("within", "beyond") and not {"lat", "lon", "km"} <= set(value or ()):
+            raise ValueError(f"{entry['op']!r} in {path} needs a value with lat, lon and km")
+        if entry["op"] in ("inside", "outside"):
+            # fail early on a missing or broken region file
+            load_regions(value)
+        rules.append(Rule(entry["reason"].format(value=value), entry["field"], entry["op"], value,
+                          entry.get("soft", False)))
+    return rules
+
+
+def lookup(record: Dict[str, Any], path: str) -> Any:
+    value = record
+    for key in path.split("."):
+        if not isinstance(value, (dict, Property)):
+            return None
+        value = value.get(key)
+    return value
+
+
+def number(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class RecordColumns:
+    """
+    columns of a batch of record dicts
+    """
+
+    def __init__(self, records: Sequence[Dict[str, Any]]):
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def values(self, field: str) -> List[Any]:
+        return [lookup(record, field) for record in self.records]
+
+    def number(self, field: str) -> np.ndarray:
+        return np.array([number(v) for v in self.values(field)], dtype=float)
+
+    def missing(self, field: str) -> np.ndarray:
+        return np.array([v is None or v == "" for v in self.values(field)], dtype=bool)
+
+    def set(self, field: str) -> np.ndarray:
+        return np.array([bool(v) for v in self.values(field)], dtype=bool)
+
+    def isin(self, field: str, values: Sequence) -> np.ndarray:
+        values = set(values)
+        return np.array([v in values for v in self.values(field)], dtype=bool)
+
+    def contains_any(self, field: str, needles: Sequence[str]) -> np.ndarray:
+        return np.array([any(needle in item.lower() for item in (v or []) for needle in needles)
+                         for v in self.values(field)], dtype=bool)
+
+
+class TableColumns:
+    """
+    columns of a pyarrow table (e.g. out.parquet), computed without converting rows to python objects
+    """
+
+    def __init__(self, table: "pyarrow.Table"):
+        self.table = table
+        self.lists: Dict[str, tuple] = {}
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def column(self, field: str) -> "pyarrow.Array":
+        top, *path = field.split(".")
+        if top not in self.table.column_names:
+            return pyarrow.nulls(self.table.num_rows)
+        column = self.table.column(top).combine_chunks()
+        for key in path:
+            column = pyarrow.compute.struct_field(column, key)
+        return column
+
+    def number(self, field: str) -> np.ndarray:
+        column = self.column(field)
+        try:
+            column = pyarrow.compute.cast(column, pyarrow.float64())
+        except pyarrow.ArrowInvalid:
+            # values which are not numbers at all
+            return np.array([number(v) for v in column.to_pylist()], dtype=float)
+        return column.fill_null(np.nan).to_numpy(zero_copy_only=False)
+
+    def missing(self, field: str) -> np.ndarray:
+        column = self.column(field)
+        missing = pyarrow.compute.is_null(column)
+        if pyarrow.types.is_string(column.type):
+            missing = pyarrow.compute.or_(missing, pyarrow.compute.equal(column, "").fill_null(True))
+        return missing.to_numpy(zero_copy_only=False)
+
+    def set(self, field: str) -> np.ndarray:
+        column = self.column(field)
+        if pyarrow.types.is_boolean(column.type):
+            return column.fill_null(False).to_numpy(zero_copy_only=False)
+        if pyarrow.types.is_string(column.type):
+            return ~self.missing(field)
+        return np.nan_to_num(self.number(field)) != 0
+
+    def isin(self, field: str, values: Sequence) -> np.ndarray:
+        column = self.column(field)
+        return pyarrow.compute.is_in(column, value_set=pyarrow.array(values)).fill_null(False).to_numpy(
+            zero_copy_only=False)
+
+    def list_items(self, field: str) -> tuple:
+        """
+        (row of every list item, index of the item in the vocabulary, vocabulary of distinct items)
+        """
+        if field not in self.lists:
+            column = self.column(field)
+            items = pyarrow.compute.dictionary_encode(pyarrow.compute.list_flatten(column))
+            self.lists[field] = (pyarrow.compute.list_parent_indices(column).to_numpy(),
+                                 items.indices.fill_null(0).to_numpy(zero_copy_only=False),
+                                 [item.lower() if item else "" for item in items.dictionary.to_pylist()])
+        return self.lists[field]
+
+    def contains_any(self, field: str, needles: Sequence[str]) -> np.ndarray:
+        if pyarrow.types.is_null(self.column(field).type):
+            return np.zeros(len(self), dtype=bool)
+        # the vocabulary is small (equipment names), so only its items are matched in python
+        rows, indices, vocabulary = self.list_items(field)
+        matching = np.array([any(needle in item for needle in needles) for item in vocabulary], dtype=bool)
+        found = matching[indices] if len(vocabulary) else np.zeros(len(indices), dtype=bool)
+        return np.bincount(rows[found], minlength=len(self)) > 0
+
+
+def evaluate(rules: Sequence[Rule], columns) -> List[np.ndarray]:
+    """
+    boolean mask of the matched records for every rule, comparisons never match missing or non numeric values
+    """
+    cache: Dict[tuple, np.ndarray] = {}
+
+    def cached(method: Callable, field: str, *args) -> np.ndarray:
+        key = (method.__name__, field) + tuple(map(str, args))
+        if key not in cache:
+            cache[key] = method(field, *args)
+        return cache[key]
+
+    def geo_index(field: str) -> GeoIndex:
+        return GeoIndex(cached(columns.number, f"{field}.N"), cached(columns.number, f"{field}.E"))
+
+    masks = []
+    for rule in rules:
+        if rule.op in GEO_OPERATORS:
+            index = cached(geo_index, rule.field)
+            if rule.op in ("within", "beyond"):
+                mask = np.zeros(len(columns), dtype=bool)
+                mask[index.within(rule.value["lat"], rule.value["lon"], rule.value["km"])[0]] = True
+            else:
+                mask = index.inside(load_regions(rule.value))
+            if rule.op in ("beyond", "outside"):
+                located = np.zeros(len(columns), dtype=bool)
+                located[index.points] = True
+                mask = located & ~mask
+        elif rule.op in COMPARISONS:
+            values = cached(columns.number, rule.field)
+            mask = COMPARISONS[rule.op](values, rule.value) & ~np.isnan(values)
+        elif rule.op == "missing":
+            mask = cached(columns.missing, rule.field)
+        elif rule.op == "set":
+            mask = cached(columns.set, rule.field)
+        elif rule.op == "in":
+            mask = cached(columns.isin, rule.field, rule.value)
+        else:
+            mask = ~cached(columns.contains_any, rule.field, rule.value)
+        masks.append(mask)
+    return masks
@@ -0,0 +1,201 @@
+"""
+local stand-in for e-chalupy.cz serving deterministic fake search results and property pages
+"""
+import argparse
+import hashlib
+import html
+import random
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+from download import MAX_REGION_ID
+
+AREAS = ["krkonose", "sumava", "cesky_raj", "beskydy", "jizerske_hory", "jeseniky", "slovensko_chaty"]
+ICONS = ["Domácí mazlíčci vítáni", "Wi-Fi zdarma", "Vhodné pro děti", "Bezbariérový přístup", "Sauna"]
+EQUIPMENT = ["Internet - Wi-Fi", "Společenská místnost", "Parkoviště u objektu", "Venkovní gril", "Krb",
+             "Myčka nádobí", "Sauna", "Stolní tenis", "Dětské hřiště", "Pračka", "Televize", "Ohniště",
+             "Parkování na pozemku", "Bazén", "Kulečník", "Terasa"]
+PLACES = ["Les", "Restaurace", "Obchod", "Autobus", "Vlak", "Koupání", "Lyžování"]
+PRICE_HEADERS = ["Ceny za objekt za den", "Ceny za objekt za týden", "Ceny za osobu za den",
+                 "Ceny za pokoj za den", "Ceny za osobu za den s polopenzí", "Ceny za objekt za den se snídaní",
+                 "Ceny za apartmán za den"]
+REVIEWS_PER_PAGE = 5
+WORDS = ["chalupa", "krásné", "prostředí", "horách", "klidném", "místě", "vybavená", "kuchyně", "pokoje",
+         "společenská", "místnost", "zahrada", "výhled", "turistika", "kolo", "rybník", "les", "ideální",
+         "skupiny", "akce", "firemní", "rodinné", "oslavy", "terasa", "krb", "sauna", "lyžování"]
+
+
+def fake_property(index: int) -> Dict[str, Any]:
+    rng = random.Random(index)
+    capacity = rng.randint(8, 60)
+    return {
+        "index": index,
+        "area": AREAS[index % len(AREAS)],
+        "name": f"Chalupa {rng.choice(WORDS).capitalize()} {index}",
+        "locality": f"Obec {index % 97}",
+        "min_capacity": rng.randint(1, 10),
+        "capacity": capacity,
+        "rooms": rng.randint(2, max(2, capacity // 3)),
+        "icons": rng.sample(ICONS, rng.randint(0, len(ICONS))),
+        "equipment": rng.sample(EQUIPMENT, rng.randint(3, len(EQUIPMENT))),
+        "distances": [(place, rng.choice([f"{rng.randint(1, 30) * 50} m", f"{rng.randint(1, 30)} km",
+                                          f"{rng.randint(1, 60)} min", "v místě"]))
+                      for place in rng.sample(PLACES, rng.randint(2, len(PLACES)))],
+        "reviews": [(f"Jaro {rng.randint(2015, 2024)}", " ".join(rng.choices(WORDS, k=rng.randint(5, 40))),
+                     rng.randint(40, 100)) for _ in range(rng.randint(0, 24))],
+        "price_header": rng.choice(PRICE_HEADERS),
+        "prices": [("Letní sezóna", rng.randint(20, 300) * 100), ("Mimo sezónu", rng.randint(15, 250) * 100)],
+        "gps": (round(rng.uniform(48.6, 51.0), 5), round(rng.uniform(12.1, 19.5), 5)),
+        "description": " ".join(rng.choices(WORDS, k=rng.randint(50, 400))),
+        "images": rng.randint(1, 20),
+    }
+
+
+def property_url(base_url: str, prop: Dict[str, Any]) -> str:
+    return f"{base_url}/{prop['area']}/chalupa-{prop['index']}.php"
+
+
+def render_region(base_url: str, region: int, per_region: int) -> str:
+    links = []
+    for index in range((region - 1) * per_region, region * per_region):
+        prop = fake_property(index)
+        links.append(f'<div class="pl"><h3><a href="{property_url(base_url, prop)}">{html.escape(prop["name"])}</a>'
+                     f' <a href="{base_url}/{prop["area"]}/">{prop["area"]}</a></h3></div>')
+    return f'<html><body><div id="vysledky_hledani">{"".join(links)}</div></body></html>'
+
+
+def render_review(season: str, text: str, rating: int) -> str:
+    return f'<div class="recenze">{season}\r\n{html.escape(text)}\r\nCelkové hodnocení: {rating}%</div>'
+
+
+def review_pages(prop: Dict[str, Any]) -> int:
+    return -(-len(prop["reviews"]) // REVIEWS_PER_PAGE)
+
+
+def render_review_page(base_url: str, prop: Dict[str, Any], page: int) -> str:
+    start = (page - 1) * REVIEWS_PER_PAGE
+    reviews = "".join(render_review(*r) for r in prop["reviews"][start:start + REVIEWS_PER_PAGE])
+    return f"""<html><body><div class="chata">
+<h1>{html.escape(prop["name"])} - hodnocení {page}/{review_pages(prop)}</h1>
+<div class="hodnoceni">{reviews}</div>
+</div></body></html>"""
+
+
+def render_property(base_url: str, prop: Dict[str, Any]) -> str:
+    n, e = prop["gps"]
+    icons = "".join(f'<img src="/i.png" alt="{html.escape(i)}">' for i in prop["icons"])
+    equipment = "".join(f'<img src="/e.png" alt="{html.escape(i)}">' for i in prop["equipment"])
+    distances = "".join(f"<tr><td>{place}</td><td>\r\n{dist}</td></tr>" for place, dist in prop["distances"])
+    # like the real site the detail shows only a random subset of the reviews with links to all of them
+    shown = random.Random(prop["index"]).sample(prop["reviews"], min(len(prop["reviews"]), REVIEWS_PER_PAGE))
+    reviews = "".join(render_review(*r) for r in shown)
+    if review_pages(prop) > 1:
+        url = property_url(base_url, prop)
+        reviews += '<div id="recenze_strany">' + "".join(f'<a href="{url}?recenze={page}">{page}</a>'
+                                                        for page in range(1, review_pages(prop) + 1)) + "</div>"
+    prices = "".join(f"<tr><td>{season} {price:,} Kč</td></tr>".replace(",", " ") for season, price in prop["prices"])
+    images = "".join(f'<a title="{html.escape(prop["name"])} {i}" href="{base_url}/img/{prop["index"]}-{i}.jpg">'
+                     f'<img src="/t.jpg"></a>' for i in range(prop["images"]))
+    return f"""<html><head><title>{html.escape(prop["name"])}</title></head><body>
+<div class="chata">
+<h1>{html.escape(prop["name"])}</h1>
+<h2>{html.escape(prop["locality"])}</h2>
+<span id="cislo_o">objekt č. {prop["index"]}</span>
+<div id="kapacita">{prop["min_capacity"]} až {prop["capacity"]} osob | {prop["rooms"]} pokojů</div>
+<div id="ikony">{icons}</div>
+<div class="menu">popis kontakty  mapa</div>
+<div class="popis">{html.escape(prop["description"])}</div>
+<p>GPS souřadnice: {n:.5f}N, {e:.5f}E</p>
+<table id="dest">{distances}</table>
+<div class="prehled">{equipment}</div>
+<div class="hodnoceni">{reviews}</div>
+<div class="kamdal">{html.escape(prop["locality"])} - další objekty v okolí</div>
+<table id="cenik"><tr><td>{prop["price_header"]}</td></tr>{prices}</table>
+<h3>Kontakt na pronajímatele nebo provozovatele</h3>
+<div id="kontakty">Telefon: +420 600 {prop["index"]:06d}
+<a href="http://www.chalupa-{prop["index"]}.cz">web</a> <a href="#">e-mail</a>
+<a href="https://www.facebook.com/chalupa{prop["index"]}">facebook</a></div>
+<a id="vetsi_mapa" href="https://mapy.cz/?x={e}&y={n}">větší mapa</a>
+<div id="nahledy">{images}</div>
+</div></body></html>"""
+
+
+def edited(index: int, revision: int, fraction: float) -> bool:
+    return revision > 0 and random.Random(f"{index}-{revision}").random() < fraction
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    per_region = 20
+    latency = 0.0
+    error_rate = 0.0
+    revision = 0
+    edited_fraction = 0.0
+
+    def base_url(self) -> str:
+        return f"http://{self.headers.get('Host')}"
+
+    def reply(self, body: str, status: int = 200, etag: bool = False):
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            status, body = 503, "try again later"
+        data = body.encode("utf-8")
+        tag = f'"{hashlib.sha1(data).hexdigest()[:16]}"'
+        if etag and status == 200 and self.headers.get("If-None-Match") == tag:
+            status, data = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        if etag:
+            self.send_header("ETag", tag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        form = urllib.parse.parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+        region = int(form.get("fid_oblasti", ["0"])[0])
+        if not 0 < region < MAX_REGION_ID:
+            return self.reply("<html><body>nic nenalezeno</body></html>")
+        self.reply(render_region(self.base_url(), region, self.per_region))
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if not url.path.endswith(".php"):
+            return self.reply("not found", 404)
+        index = int(url.path.rsplit("-", 1)[1][:-len(".php")])
+        prop = fake_property(index)
+        review_page = urllib.parse.parse_qs(url.query).get("recenze")
+        if review_page:
+            return self.reply(render_review_page(self.base_url(), prop, int(review_page[0])), etag=True)
+        if edited(index, self.revision, self.edited_fraction):
+            prop["description"] += f" (upraveno {self.revision})"
+        self.reply(render_property(self.base_url(), prop), etag=True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve a fake e-chalupy.cz for crawler tests and benchmarks")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--per-region", type=int, default=FixtureHandler.per_region,
+                        help="properties listed in every region")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds to wait before every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of responses failing with 503")
+    parser.add_argument("--revision", type=int, default=0, help="site revision, every revision edits some listings")
+    parser.add_argument("--edited-fraction", type=float, default=0.05,
+                        help="fraction of listings edited in every revision")
+    args = parser.parse_args()
+
+    FixtureHandler.per_region = args.per_region
+    FixtureHandler.latency = args.latency
+    FixtureHandler.error_rate = args.error_rate
+    FixtureHandler.revision = args.revision
+    FixtureHandler.edited_fraction = args.edited_fraction
+    print(f"serving on http://127.0.0.1:{args.port}")
+    ThreadingHTTPServer(("127.0.0.1", args.port), FixtureHandler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+grid index over property GPS coordinates for radius, nearest neighbour and GeoJSON region queries,
+run `python3 geo.py --help` to query out.json
+"""
+import argparse
+import json
+import math
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# side of a grid cell, about 11 x 7 km in Czechia
+CELL_DEGREES = 0.1
+# cell columns are packed below the cell row into one sortable key
+KEY_SHIFT = 32
+
+Polygon = List[np.ndarray]  # outer ring and holes, arrays of (lon, lat) vertices like in GeoJSON
+
+
+def coordinates(gps: Any) -> Tuple[float, float]:
+    """
+    (latitude, longitude) of a GPS field ({"N": "50.1", "E": "14.4"}), nan when missing or malformed
+    """
+    try:
+        return float(gps["N"]), float(gps["E"])
+    except (TypeError, KeyError, ValueError):
+        return math.nan, math.nan
+
+
+def haversine_km(lat: np.ndarray, lon: np.ndarray, lat0: float, lon0: float) -> np.ndarray:
+    lat, lon, lat0, lon0 = np.radians(lat), np.radians(lon), math.radians(lat0), math.radians(lon0)
+    a = np.sin((lat - lat0) / 2) ** 2 + math.cos(lat0) * np.cos(lat) * np.sin((lon - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def in_rings(lat: np.ndarray, lon: np.ndarray, rings: Sequence[np.ndarray]) -> np.ndarray:
+    """
+    even-odd ray casting over all rings, so holes are excluded
+    """
+    inside = np.zeros(len(lat), dtype=bool)
+    for ring in rings:
+        x0, y0 = ring[:, 0], ring[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        for ax, ay, bx, by in zip(x0, y0, x1, y1):
+            if ay == by:
+                continue
+            crosses = (ay > lat) != (by > lat)
+            inside ^= crosses & (lon < ax + (lat - ay) * (bx - ax) / (by - ay))
+    return inside
+
+
+@lru_cache(maxsize=16)
+def load_regions(path: str) -> Tuple[Polygon, ...]:
+    """
+    polygons of all (multi)polygon geometries of a GeoJSON file
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    geometries = []
+    for item in data.get("features", [data]):
+        geometry = item.get("geometry", item)
+        if geometry.get("type") == "GeometryCollection":
+            geometries += geometry["geometries"]
+        else:
+            geometries.append(geometry)
+    polygons = []
+    for geometry in geometries:
+        if geometry["type"] == "Polygon":
+            polygons.append(geometry["coordinates"])
+        elif geometry["type"] == "MultiPolygon":
+            polygons += geometry["coordinates"]
+    if not polygons:
+        raise ValueError(f"no polygons in {path}")
+    return tuple([np.array(ring, dtype=float)[:, :2] for ring in polygon] for polygon in polygons)
+
+
+class GeoIndex:
+    """
+    points bucketed into CELL_DEGREES cells, sorted by cell so a rectangle of cells is one slice per cell row,
+    queries only compute distances for the points of the cells around them (no wrap around the antimeridian)
+    """
+
+    def __init__(self, lat: Sequence[float], lon: Sequence[float], cell: float = CELL_DEGREES):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.cell = cell
+        valid = np.flatnonzero(~(np.isnan(self.lat) | np.isnan(self.lon)))
+        keys = self.key(np.floor(self.lat[valid] / cell), np.floor(self.lon[valid] / cell))
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.points = valid[order]
+
+    @staticmethod
+    def key(row, col):
+        return (np.asarray(row, dtype=np.int64) << KEY_SHIFT) + (np.asarray(col, dtype=np.int64) + (1 << 31))
+
+    def __len__(self):
+        return len(self.points)
+
+    def in_box(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float) -> np.ndarray:
+        """
+        points of the cells overlapping the box (a superset of the points inside it)
+        """
+        rows = np.arange(math.floor(lat_min / self.cell), math.floor(lat_max / self.cell) + 1)
+        col_min, col_max = math.floor(lon_min / self.cell), math.floor(lon_max / self.cell)
+        starts = np.searchsorted(self.keys, self.key(rows, col_min))
+        ends = np.searchsorted(self.keys, self.key(rows, col_max), side="right")
+        if len(rows) == 1:
+            return self.points[starts[0]:ends[0]]
+        return np.concatenate([self.points[s:e] for s, e in zip(starts, ends) if e > s] or [self.points[:0]])
+
+    def within(self, lat: float, lon: float, km: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (indices, distances in km) of the points within `km` of the point, nearest first
+        """
+        lat_span = km / KM_PER_DEGREE
+        cos = math.cos(math.radians(min(90.0, abs(lat) + lat_span)))
+        lon_span = km / (KM_PER_DEGREE * cos) if cos > 1e-9 else 360.0
+        candidates = self.in_box(max(-90.0, lat - lat_span), min(90.0, lat + lat_span),
+                                 max(-180.0, lon - min(lon_span, 360.0)), min(180.0, lon + min(lon_span, 360.0)))
+        distances = haversine_km(self.lat[candidates], self.lon[candidates], lat, lon)
+        found = distances <= km
+        candidates, distances = candidates[found], distances[found]
+        order = np.argsort(distances, kind="stable")
+        return candidates[order], distances[order]
+
+    def nearest(self, lat: float, lon: float, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (indices, distances in km) of the `k` nearest points, the radius doubles until enough points are found
+        """
+        km = self.cell * KM_PER_DEGREE
+        while True:
+            indices, distances = self.within(lat, lon, km)
+            if len(indices) >= k or km > math.pi * EARTH_RADIUS_KM:
+                return indices[:k], distances[:k]
+            km *= 2
+
+    def inside(self, polygons: Iterable[Polygon]) -> np.ndarray:
+        """
+        mask of the points inside any of the polygons
+        """
+        mask = np.zeros(len(self.lat), dtype=bool)
+        for polygon in polygons:
+            outer = polygon[0]
+            candidates = self.in_box(outer[:, 1].min(), outer[:, 1].max(), outer[:, 0].min(), outer[:, 0].max())
+            mask[candidates[in_rings(self.lat[candidates], self.lon[candidates], polygon)]] = True
+        return mask
+
+
+def index_records(records: Iterable[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], GeoIndex]:
+    records = list(records)
+    lat, lon = zip(*(coordinates(record.get("GPS")) for record in records)) if records else ((), ())
+    return records, GeoIndex(lat, lon)
+
+
+def point(text: str) -> Tuple[float, float]:
+    lat, lon = map(float, text.split(","))
+    return lat, lon
+
+
+def main():
+    parser = argparse.ArgumentParser(description="geographic queries over the processed properties")
+    parser.add_argument("--input", default="out.json", help="JSON lines with GPS fields (process.py output)")
+    parser.add_argument("--near", type=point, metavar="LAT,LON", help="query point, e.g. 50.0755,14.4378 (Prague)")
+    parser.add_argument("--km", type=float, help="properties within this distance of --near")
+    parser.add_argument("-k", type=int, default=10, help="nearest properties to --near without --km")
+    parser.add_argument("--region", help="properties inside the polygons of a GeoJSON file")
+    parser.add_argument("--all", action="store_true", help="include filtered out properties")
+    args = parser.parse_args()
+    if not args.near and not args.region:
+        parser.error("give --near or --region")
+
+    with open(args.input, encoding="utf-8") as f:
+        records, index = index_records(r for r in map(json.loads, f) if args.all or not r.get("filtered"))
+    if args.region:
+        selected = np.flatnonzero(index.inside(load_regions(args.region)))
+        if args.near:
+            distances = haversine_km(index.lat[selected], index.lon[selected], *args.near)
+            order = np.argsort(distances, kind="stable")
+            selected, distances = selected[order], distances[order]
+        else:
+            distances = [None] * len(selected)
+    elif args.km is not None:
+        selected, distances = index.within(*args.near, args.km)
+    else:
+        selected, distances = index.nearest(*args.near, args.k)
+    for i, distance in zip(selected, distances):
+        record = records[i]
+        prefix = f"{distance:7.1f} km  " if distance is not None else ""
+        print(f"{prefix}{record.get('name')} ({record.get('locality')})  {record.get('url')}")
+    print(f"\n{len(selected)} of {len(records)} properties")
+
+
+if __name__ == '__main__':
+    main()
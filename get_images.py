@@ -4,13 +4,17 @@ import os.path
 import requests
 import urllib.parse
 
+from metrics import METRICS
+from storage import read_lines
+
 OBJECTS_JSON_PATH = "out.json"
 
 
 def load_objects():
-    return json.load(open(OBJECTS_JSON_PATH))
+    return [json.loads(line) for line in read_lines(OBJECTS_JSON_PATH)]
 
 
+@METRICS.timed("image_download")
 def download_image(url):
     return requests.get(url).content
 
@@ -28,10 +32,13 @@ def main():
             if os.path.exists(final_path):
                 continue
             img = download_image(image_url)
+            METRICS.count("image_bytes", len(img))
             with open(final_path, 'wb') as f:
                 f.write(img)
         print(f"done {i}/{total}")
 
+    METRICS.write("images")
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,75 @@
+import gzip
+import json
+import os
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from journal import content_hash
+
+CACHE_DIR = "html-cache"
+
+
+def object_path(root: str, sha256: str) -> str:
+    return os.path.join(root, "objects", sha256[:2], sha256 + ".html.gz")
+
+
+def read_page(root: str, entry: Dict[str, str]) -> str:
+    with gzip.open(object_path(root, entry["sha256"]), "rb") as f:
+        return f.read().decode(entry.get("encoding") or "utf-8", errors="replace")
+
+
+class HtmlCache:
+    """
+    raw property pages stored gzip compressed under their sha256 (objects/ab/abcd...html.gz),
+    index.jsonl maps every url to the hash of its latest body, identical bodies are stored once
+    """
+
+    def __init__(self, root: str = CACHE_DIR):
+        self.root = root
+        self.index_path = os.path.join(root, "index.jsonl")
+        self.index: Dict[str, Dict[str, str]] = {}
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.index[entry["url"]] = entry
+        self.f = None
+
+    def put(self, url: str, body: bytes, encoding: str = "utf-8") -> str:
+        sha256 = content_hash(body)
+        path = object_path(self.root, sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        if self.index.get(url, {}).get("sha256") != sha256:
+            entry = {"url": url, "sha256": sha256, "encoding": encoding, "fetched": int(time.time())}
+            self.index[url] = entry
+            if self.f is None:
+                self.f = open(self.index_path, "a", encoding="utf-8")
+            self.f.write(json.dumps(entry) + "\n")
+            self.f.flush()
+        return sha256
+
+    def get(self, url: str) -> Optional[str]:
+        entry = self.index.get(url)
+        if not entry:
+            return None
+        return read_page(self.root, entry)
+
+    def pages(self) -> Iterable[Tuple[str, str]]:
+        for url in self.index:
+            yield url, self.get(url)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
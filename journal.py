@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, Mapping, Optional, Set, TextIO
+
+JOURNAL_PATH = "crawl-journal.jsonl"
+
+
+def content_hash(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+class CrawlJournal:
+    """
+    append-only log of a crawl, one JSON object per line:
+        {"crawl": id}                           start of a crawl, following lines belong to it
+        {"region": n, "urls": [...]}            region sweep result
+        {"url": u, "sha256": h, "etag": ..}     page fetched and its record written (or unchanged)
+        {"carried": u}                          unchanged record copied from the previous output
+    entries are written only after the corresponding output was flushed, so everything in the journal is on disk
+    """
+
+    def __init__(self, path: str = JOURNAL_PATH, resume: bool = False, incremental: bool = False):
+        self.path = path
+        self.incremental = incremental
+        self.pages: Dict[str, Dict[str, Any]] = {}  # latest entry for every url ever crawled
+        self.crawl_id = None
+        self.regions: Dict[int, Set[str]] = {}
+        self.done: Set[str] = set()
+        self.unchanged: Set[str] = set()
+        self.carried: Set[str] = set()
+        if os.path.exists(path):
+            self.load()
+        if not resume or self.crawl_id is None:
+            self.start()
+        drop_partial_line(path)
+        self.f = open(path, "a", encoding="utf-8")
+
+    def load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn write at the end of an interrupted crawl
+                    continue
+                if "crawl" in entry:
+                    self.crawl_id = entry["crawl"]
+                    self.regions, self.done, self.unchanged, self.carried = {}, set(), set(), set()
+                elif "region" in entry:
+                    self.regions[entry["region"]] = set(entry["urls"])
+                elif "url" in entry:
+                    self.pages[entry["url"]] = entry
+                    self.done.add(entry["url"])
+                    if not entry.get("changed", True):
+                        self.unchanged.add(entry["url"])
+                elif "carried" in entry:
+                    self.carried.add(entry["carried"])
+
+    def start(self):
+        """
+        start a new crawl, the journal is compacted to the latest entry of every page
+        """
+        self.crawl_id = int(time.time())
+        self.regions, self.done, self.unchanged, self.carried = {}, set(), set(), set()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"crawl": "compacted"}) + "\n")
+            for entry in self.pages.values():
+                f.write(json.dumps(entry) + "\n")
+            f.write(json.dumps({"crawl": self.crawl_id}) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def append(self, entry: Dict[str, Any]):
+        self.f.write(json.dumps(entry) + "\n")
+        self.f.flush()
+
+    def region(self, region: int) -> Optional[Set[str]]:
+        return self.regions.get(region)
+
+    def record_region(self, region: int, urls: Set[str]):
+        self.regions[region] = urls
+        self.append({"region": region, "urls": sorted(urls)})
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        entry = self.pages.get(url)
+        if not self.incremental or not entry:
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def changed(self, url: str, status: int, body: bytes) -> bool:
+        """
+        whether the page has to be parsed again, always true outside of incremental mode
+        """
+        entry = self.pages.get(url)
+        if not self.incremental or not entry:
+            return True
+        if status == 304:
+            return False
+        return content_hash(body) != entry.get("sha256")
+
+    def record_page(self, url: str, status: int, headers: Mapping[str, str], body: bytes, changed: bool):
+        entry = dict(self.pages.get(url, {}), url=url, changed=changed)
+        if status != 304:
+            entry.update(sha256=content_hash(body), etag=headers.get("ETag"), last_modified=headers.get("Last-Modified"))
+        self.pages[url] = entry
+        self.done.add(url)
+        if not changed:
+            self.unchanged.add(url)
+        self.append(entry)
+
+    def carry_unchanged(self, previous: Iterable[str], out: TextIO) -> int:
+        """
+        copy records of unchanged pages from the previous crawl output
+        """
+        carried = 0
+        for line in previous:
+            url = json.loads(line)["url"]
+            if url not in self.unchanged or url in self.carried:
+                continue
+            out.write(line.rstrip("\n") + "\n")
+            out.flush()
+            self.carried.add(url)
+            self.append({"carried": url})
+            carried += 1
+        return carried
+
+    def close(self):
+        self.f.close()
+
+
+def drop_partial_line(path: str):
+    """
+    cut a record torn by an interrupted crawl from the end of the output
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline != -1:
+                f.truncate(start + newline + 1)
+                return
+            end = start
+        f.truncate(0)
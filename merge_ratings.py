@@ -1,11 +1,13 @@
 import csv
-import json
 
+from ratings_store import RatingsStore, aggregated
 from utils import numeric_stats
 
 
 def main():
-    ratings = json.load(open("ratings.json"))
+    store = RatingsStore()
+    ratings = store.to_dict()
+    store.close()
 
     properties = []
 
@@ -14,13 +16,14 @@ def main():
         for r in reader:
             prop_ratings = []
             if r["id"] in ratings:
+                averaged = aggregated(ratings[r["id"]])
                 for rating_name, rating_value in ratings[r["id"]].items():
                     if type(rating_value) is dict:
                         for k, v in rating_value.items():
                             r[rating_name + "_" + k] = v
                     else:
                         r[rating_name] = rating_value
-                    if "rating" in rating_value and "v3" in rating_name and "llama3.2_v3" != rating_name:
+                    if "rating" in rating_value and rating_name in averaged:
                         prop_ratings.append(float(rating_value["rating"]))
 
             if prop_ratings:
@@ -0,0 +1,175 @@
+"""
+run instrumentation shared by the pipeline scripts: time and items per stage, counters and peak memory,
+written as a JSON run report and a Prometheus textfile (for node_exporter's textfile collector)
+"""
+import cProfile
+import json
+import logging
+import os
+import resource
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional
+
+METRICS_DIR = "metrics"
+PROMETHEUS_PREFIX = "scraper"
+
+
+class Timer:
+    """
+    times a `with` block as one call of a stage, `items` can be changed inside the block
+    """
+
+    def __init__(self, metrics: "Metrics", name: str, items: int):
+        self.metrics = metrics
+        self.name = name
+        self.items = items
+
+    def __enter__(self) -> "Timer":
+        if self.name == self.metrics.profile_stage:
+            self.metrics.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add(self.name, time.perf_counter() - self.start, self.items)
+        if self.name == self.metrics.profile_stage:
+            self.metrics.profiler.disable()
+
+
+class Metrics:
+    """
+    stage name -> [seconds, calls, items] and named counters of one run, worker processes send their
+    snapshot() to be merged; the seconds of concurrent calls (async fetches) add up to more than the wall time
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.stages: Dict[str, List] = {}
+        self.counters: Dict[str, int] = {}
+        self.profile_stage: Optional[str] = None
+        self.profiler: Optional[cProfile.Profile] = None
+
+    def stage(self, name: str, items: int = 1) -> Timer:
+        return Timer(self, name, items)
+
+    def timed(self, name: str, items: int = 1) -> Callable:
+        """
+        decorator timing every call of a function as the stage `name`
+        """
+        def decorator(fn: Callable) -> Callable:
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name, items):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, name: str, seconds: float, items: int = 1, calls: int = 1):
+        stage = self.stages.setdefault(name, [0.0, 0, 0])
+        stage[0] += seconds
+        stage[1] += calls
+        stage[2] += items
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def profile(self, stage: Optional[str]):
+        """
+        collect a cProfile of every call of `stage`, dumped next to the report
+        """
+        self.profile_stage = stage
+        self.profiler = cProfile.Profile() if stage else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"stages": self.stages, "counters": self.counters}
+
+    def reset(self):
+        """
+        empty metrics without profiling, for a worker process collecting the metrics of one task
+        """
+        self.stages, self.counters = {}, {}
+        self.profile(None)
+
+    def merge(self, snapshot: Dict[str, Any]):
+        for name, (seconds, calls, items) in snapshot["stages"].items():
+            self.add(name, seconds, items, calls)
+        for name, n in snapshot["counters"].items():
+            self.count(name, n)
+
+    def report(self, run: str, **extra) -> Dict[str, Any]:
+        seconds = time.perf_counter() - self.start
+        return {
+            "run": run,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started)),
+            "started_timestamp": self.started,
+            "seconds": seconds,
+            # ru_maxrss is in kilobytes on linux, the children are the worker processes
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "children_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            "stages": {name: {"seconds": s, "calls": calls, "items": items, "items_per_s": items / s if s else 0.0}
+                       for name, (s, calls, items) in self.stages.items()},
+            "counters": self.counters,
+            **extra,
+        }
+
+    def write(self, run: str, directory: str = METRICS_DIR, **extra) -> Dict[str, Any]:
+        """
+        <directory>/<run>.json, <run>.prom and the profile (<run>-<stage>.prof), replaced atomically
+        """
+        report = self.report(run, **extra)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, run)
+        write_atomic(f"{path}.json", json.dumps(report, indent=2, default=str) + "\n")
+        write_atomic(f"{path}.prom", prometheus_text(report))
+        if self.profiler is not None:
+            self.profiler.dump_stats(f"{path}-{self.profile_stage}.prof")
+            logging.info(f"profile of {self.profile_stage} in {path}-{self.profile_stage}.prof")
+        return report
+
+
+def write_atomic(path: str, text: str):
+    # the textfile collector may read at any time
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(report: Dict[str, Any]) -> str:
+    run = f'run="{label(report["run"])}"'
+    metrics = [
+        ("stage_seconds_total", "counter", "seconds spent in a stage", "seconds"),
+        ("stage_calls_total", "counter", "calls of a stage", "calls"),
+        ("stage_items_total", "counter", "items processed by a stage", "items"),
+        ("stage_items_per_second", "gauge", "items processed by a stage per second in it", "items_per_s"),
+    ]
+    lines = []
+    for name, kind, description, key in metrics:
+        lines += [f"# HELP {PROMETHEUS_PREFIX}_{name} {description}", f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}"]
+        lines += [f'{PROMETHEUS_PREFIX}_{name}{{{run},stage="{label(stage)}"}} {values[key]}'
+                  for stage, values in report["stages"].items()]
+    lines += [f"# HELP {PROMETHEUS_PREFIX}_events_total counted events of a run",
+              f"# TYPE {PROMETHEUS_PREFIX}_events_total counter"]
+    lines += [f'{PROMETHEUS_PREFIX}_events_total{{{run},name="{label(name)}"}} {n}'
+              for name, n in report["counters"].items()]
+    gauges = [
+        ("run_seconds", "wall clock duration of the run", report["seconds"]),
+        ("peak_rss_bytes", "peak resident memory of the main process", report["peak_rss_mb"] * 1024 * 1024),
+        ("children_peak_rss_bytes", "peak resident memory of the largest worker process",
+         report["children_peak_rss_mb"] * 1024 * 1024),
+        ("last_run_timestamp_seconds", "start of the run", report["started_timestamp"]),
+    ]
+    for name, description, value in gauges:
+        lines += [f"# HELP {PROMETHEUS_PREFIX}_{name} {description}", f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge",
+                  f"{PROMETHEUS_PREFIX}_{name}{{{run}}} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+# the metrics of this process, like the root logger
+METRICS = Metrics()
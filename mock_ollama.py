@@ -0,0 +1,130 @@
+"""
+local stand-in for an Ollama server answering /api/generate with deterministic fake ratings after a configurable
+latency, for testing rank.py throughput offline: `python3 rank.py --host http://127.0.0.1:11435 --parallel 8`,
+every slot keeps its last prompt and only evaluates the part after the prefix shared with it, like the kv cache,
+one model is loaded at a time and a request for another one waits for it to load
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+DESCRIPTIONS = ["Fancy wooden cottage with sauna.", "Big chalet with a common room.", "Moldy dump.",
+                "Guesthouse with the owner on site.", "Remote cottage in the woods."]
+
+
+def fake_rating(prompt: str) -> Dict[str, Any]:
+    rng = random.Random(hashlib.sha1(prompt.encode("utf-8")).digest())
+    return {
+        "rating": round(rng.random(), 2),
+        "description": rng.choice(DESCRIPTIONS),
+        "owner_in_house": rng.random() < 0.2,
+        "explanation": "Rated by mock_ollama.py.",
+    }
+
+
+class OllamaHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    per_token = 0.0
+    failure_rate = 0.0
+    load = 0.0
+    loaded = ""
+    loading = threading.Lock()
+    # generations running at once like OLLAMA_NUM_PARALLEL, the other requests wait, (model, last prompt) per slot
+    slots: "queue.Queue[list]" = queue.Queue()
+
+    def reply(self, body: bytes, status: int = 200, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            return self.reply(json.dumps({"version": "0.0.0-mock"}).encode())
+        self.reply(b"404 page not found", 404, "text/plain")
+
+    def do_POST(self):
+        if self.path != "/api/generate":
+            return self.reply(b"404 page not found", 404, "text/plain")
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model, prompt = request.get("model", ""), request.get("prompt") or ""
+        start = time.monotonic()
+        if not prompt and request.get("keep_alive") == 0:
+            with self.loading:
+                if OllamaHandler.loaded == model:
+                    OllamaHandler.loaded = ""
+            return self.reply(json.dumps({"model": model, "response": "", "done": True,
+                                          "done_reason": "unload"}).encode())
+        with self.loading:
+            if OllamaHandler.loaded != model:
+                print(f"loading {model}", flush=True)
+                time.sleep(self.load)
+                OllamaHandler.loaded = model
+        load_duration = time.monotonic() - start
+        slot = self.slots.get()
+        try:
+            cached = os.path.commonprefix([slot[1], prompt]) if slot[0] == model else ""
+            # about 4 characters per token
+            prompt_tokens = (len(prompt) - len(cached)) // 4
+            time.sleep(self.latency + self.per_token * prompt_tokens)
+            slot[:] = [model, prompt]
+        finally:
+            self.slots.put(slot)
+        text = json.dumps(fake_rating(prompt))
+        failed = random.random() < self.failure_rate
+        if failed and request.get("format"):
+            # a `format` schema constrains the output to its shape but not its values
+            text = json.dumps({**fake_rating(prompt), "rating": 7})
+        elif failed:
+            text = "I am sorry, I can not rate this accommodation."
+        response = {
+            "model": model,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "response": text,
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": int((time.monotonic() - start) * 1e9),
+            "load_duration": int(load_duration * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": len(text) // 4,
+        }
+        if request.get("stream", True):
+            return self.reply(json.dumps(response).encode() + b"\n", content_type="application/x-ndjson")
+        self.reply(json.dumps(response).encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve a fake Ollama /api/generate for rank.py tests and benchmarks")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds every generation takes")
+    parser.add_argument("--per-token", type=float, default=0.0, help="additional seconds per prompt token")
+    parser.add_argument("--slots", type=int, default=4, help="generations running at once, like OLLAMA_NUM_PARALLEL")
+    parser.add_argument("--load", type=float, default=0.0, help="seconds loading another model takes")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="fraction of responses which are not a valid rating")
+    args = parser.parse_args()
+
+    OllamaHandler.latency = args.latency
+    OllamaHandler.per_token = args.per_token
+    OllamaHandler.failure_rate = args.failure_rate
+    OllamaHandler.load = args.load
+    for _ in range(args.slots):
+        OllamaHandler.slots.put(["", ""])
+    print(f"serving on http://127.0.0.1:{args.port}")
+    ThreadingHTTPServer(("127.0.0.1", args.port), OllamaHandler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+property page extraction over interchangeable html parser backends, every backend gives identical records
+"""
+import logging
+import re
+from html import unescape
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+import record
+from record import Property
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+DEFAULT_BACKEND = "html.parser"
+
+capacity_extractor = re.compile(r"(?:\d*\saž\s)?(\d+)\sosob(?:\s\|\s(\d+)?)?")
+gps_extractor = re.compile(r"GPS .*: (\d+.\d+)N, (\d+.\d+)E")
+rating_extractor = re.compile(r"Celkové hodnocení:\s+(\d+)%", re.UNICODE)
+# links to the pages listing all reviews of a property, found without building a tree
+review_page_extractor = re.compile(r'href="([^"#]*[?&](?:amp;)?recenze=\d+)"')
+# html5 parsers turn \r\n into \n, carriage returns in text are escaped to keep the text identical to html.parser
+text_carriage_return = re.compile(r"\r(?=[^<>]*(?:<|\Z))")
+
+
+def clean(s: str) -> str:
+    return s.replace('\r', '').replace('\n', '')
+
+
+class SoupPage:
+    def __init__(self, html: str, features: str):
+        if features != "html.parser":
+            html = text_carriage_return.sub("&#13;", html)
+        # only the property itself is turned into a tree
+        self.root = BeautifulSoup(html, features, parse_only=SoupStrainer(class_="chata")).find(class_="chata")
+
+    def by_id(self, name: str):
+        return self.root.find(id=name)
+
+    def by_class(self, name: str) -> List:
+        return self.root.find_all(class_=name)
+
+    def first_by_class(self, name: str):
+        return self.root.find(class_=name)
+
+    def first(self, node, tag: str):
+        return node.find(tag)
+
+    def tags(self, node, tag: Optional[str] = None) -> List:
+        return node.find_all(tag)
+
+    def text(self, node) -> str:
+        return node.text
+
+    def attr(self, node, name: str) -> Optional[str]:
+        return node.get(name)
+
+
+class LexborPage:
+    def __init__(self, html: str):
+        if LexborHTMLParser is None:
+            raise RuntimeError("selectolax backend requires `pip install selectolax`")
+        tree = LexborHTMLParser(text_carriage_return.sub("&#13;", html))
+        # BeautifulSoup leaves script and style contents out of the text
+        tree.strip_tags(["script", "style"])
+        self.root = tree.css_first(".chata")
+
+    def by_id(self, name: str):
+        return self.root.css_first(f"#{name}")
+
+    def by_class(self, name: str) -> List:
+        return self.root.css(f".{name}")
+
+    def first_by_class(self, name: str):
+        return self.root.css_first(f".{name}")
+
+    def first(self, node, tag: str):
+        return node.css_first(tag)
+
+    def tags(self, node, tag: Optional[str] = None) -> List:
+        found = node.css(tag or "*")
+        # unlike find_all the css selection starts with the node itself when it matches
+        return found[1:] if found and found[0] == node else found
+
+    def text(self, node) -> str:
+        return node.text(deep=True)
+
+    def attr(self, node, name: str) -> Optional[str]:
+        value = node.attributes.get(name)
+        if value is None and name in node.attributes:
+            return ""
+        return value
+
+
+BACKENDS = {
+    "html.parser": lambda html: SoupPage(html, "html.parser"),
+    "lxml": lambda html: SoupPage(html, "lxml"),
+    "selectolax": LexborPage,
+}
+
+
+def review_page_links(url: str, html: str) -> List[str]:
+    """
+    urls of the review listing pages in page order, empty when the property shows all its reviews
+    """
+    links = []
+    for link in review_page_extractor.findall(html):
+        link = urljoin(url, unescape(link))
+        if link != url and link not in links:
+            links.append(link)
+    return links
+
+
+def is_review_page(url: str) -> bool:
+    return review_page_extractor.search(f'href="{url}"') is not None
+
+
+def parse_reviews(html: str, backend: str = DEFAULT_BACKEND) -> List[str]:
+    page = BACKENDS[backend](html)
+    if page.root is None:
+        return []
+    return [page.text(i) for i in page.by_class("recenze")]
+
+
+def parse_property(url: str, html: str, backend: str = DEFAULT_BACKEND,
+                   review_pages: Sequence[str] = ()) -> Dict[str, Any]:
+    """
+    `review_pages` are the html of the pages from review_page_links, their reviews replace the random subset
+    shown on the property page
+    """
+    page = BACKENDS[backend](html)
+    prop = page.root
+    text = page.text(prop)
+    capacity = capacity_extractor.search(clean(page.text(page.by_id("kapacita"))))
+    contact = page.by_id("kontakty")
+    logging.info(url)
+    gps = gps_extractor.search(text)
+    distances = page.by_id("dest")
+    pricelist = page.by_id("cenik")
+    if review_pages:
+        ratings = [review for html in review_pages for review in parse_reviews(html, backend)]
+    else:
+        ratings = [page.text(i) for i in page.by_class("recenze")]
+    data = {
+        "url": url,
+        "id": page.text(page.by_id("cislo_o")),
+        "name": page.text(page.first(prop, "h1")),
+        "locality": page.text(page.first(prop, "h2")),
+        "capacity": capacity.group(1),
+        "rooms": capacity.group(2),
+        "icons": [page.attr(i, "alt") for i in page.tags(page.by_id("ikony"))],
+        "contact_raw": clean(page.text(contact)),
+        "contact_links": [page.attr(i, "href") for i in page.tags(contact, "a")],
+        "map_link": page.attr(page.by_id("vetsi_mapa"), "href"),
+        "distances": [(clean(page.text(cells[0])), clean(page.text(cells[1]))) for cells in
+                      (page.tags(i, "td") for i in page.tags(distances, "tr"))] if distances is not None else [],
+        "equipment": [page.attr(j, "alt") for i in page.by_class("prehled") for j in page.tags(i, "img")],
+        "ratings": ratings,
+        "numeric_ratings": [m.group(1) for m in map(rating_extractor.search, ratings) if m],
+        "place": clean(page.text(page.first_by_class("kamdal"))),
+        "pricelist": [clean(page.text(i)) for i in page.tags(pricelist, "td")] if pricelist is not None else [],
+        "images": [(page.attr(i, "title"), page.attr(i, "href")) for i in page.tags(page.by_id("nahledy"), "a")],
+        "text": text,
+    }
+    if gps:
+        data.update({
+            "GPS": {
+                "N": gps.group(1),
+                "E": gps.group(2),
+            }
+        })
+    return data
+
+
+def parse_line(url: str, html: str, backend: str = DEFAULT_BACKEND, review_pages: Sequence[str] = ()) -> str:
+    """
+    parsed property as a JSON line, serialized where it was parsed so pool workers send back only a string
+    """
+    return record.encode(Property(**parse_property(url, html, backend, review_pages))) + "\n"
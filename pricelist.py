@@ -0,0 +1,125 @@
+"""
+structured pricelists, the `pricelist` cells of a property page parsed in one pass into priced sections
+"""
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# header words (lowercase prefixes of whole words) of the section attributes, highest priority first, a header
+# naming several of one kind ("Cena za apartmán pro 4 osoby") gets the first of them
+UNITS = {
+    "object": ["objekt", "chat", "chalup", "dům"],
+    "apartment": ["apartmán"],
+    "room": ["pokoj"],
+    "person": ["osob"],
+}
+PERIODS = {
+    "week": ["týden"],
+    "weekend": ["víkend"],
+    "day": ["den", "noc"],
+}
+BOARDS = {
+    "full_board": ["plnou penzí", "plná penze"],
+    "half_board": ["polop"],
+    "breakfast": ["snídaní", "snídaně"],
+}
+# nights a price of the period is for
+NIGHTS = {"day": 1, "week": 7, "weekend": 2}
+# sections the normalized price is taken from, best first
+PREFERRED_UNITS = ["object", "room", "person"]
+
+# a cell is a section header, a priced row (the season before the first amount) or something else (notes,
+# malformed rows), two plain patterns are faster than one alternation matching the season lazily
+header_matcher = re.compile(r"cen[ay]?\b", re.IGNORECASE)
+amount_extractor = re.compile(r"\s*(\d{1,3}(?:[ .]\d{3})+|\d+)\s?(?:,-)?\s?Kč", re.IGNORECASE)
+ATTRIBUTES = (("unit", UNITS), ("period", PERIODS), ("board", BOARDS))
+header_extractor = re.compile(r"\b(?:" + "|".join(f"(?P<{kind}_{name}>{'|'.join(map(re.escape, words))})"
+                                                  for kind, attributes in ATTRIBUTES
+                                                  for name, words in attributes.items()) + ")")
+
+
+class Section(NamedTuple):
+    header: str
+    unit: Optional[str]  # object, person, room, apartment
+    period: Optional[str]  # day, week, weekend
+    board: Optional[str]  # full_board, half_board, breakfast
+    prices: List[Tuple[str, int]]  # (season, amount in Kč)
+    unpriced: List[str]  # rows without a price
+
+    def price(self) -> Optional[Tuple[str, int]]:
+        """
+        main season price, the summer or off-season row if there is one
+        """
+        for season, amount in self.prices:
+            if season.lower().startswith(("let", "mimo")):
+                return season, amount
+        return self.prices[0] if self.prices else None
+
+    def to_dict(self) -> Dict:
+        return {"header": self.header, "unit": self.unit, "period": self.period, "board": self.board,
+                "prices": [{"season": season, "amount": amount} for season, amount in self.prices]}
+
+
+@lru_cache(maxsize=1024)
+def header_attributes(header: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    # headers repeat across the whole site, every distinct one is matched once
+    found = {m.lastgroup for m in header_extractor.finditer(header.lower())}
+    return tuple(next((name for name in attributes if f"{kind}_{name}" in found), None)
+                 for kind, attributes in ATTRIBUTES)
+
+
+def parse_pricelist(cells: Iterable[str]) -> List[Section]:
+    """
+    sections in page order, a section starts at every "Ceny za ..." or "Cena za ..." header, priced rows before
+    the first header form a section without attributes
+    """
+    sections: List[Section] = []
+    section = None
+    for cell in cells:
+        if header_matcher.match(cell):
+            section = Section(cell, *header_attributes(cell), [], [])
+            sections.append(section)
+            continue
+        if section is None:
+            section = Section("", None, None, None, [], [])
+            sections.append(section)
+        m = amount_extractor.search(cell)
+        if m:
+            section.prices.append((cell[:m.start()], int(m.group(1).replace(" ", "").replace(".", ""))))
+        elif cell:
+            section.unpriced.append(cell)
+    return sections
+
+
+def preferred_section(sections: List[Section]) -> Optional[Section]:
+    """
+    first priced section of the best unit, sections without a unit count as per object
+    """
+    priced = [s for s in sections if s.prices]
+    for unit in PREFERRED_UNITS:
+        for section in priced:
+            if (section.unit or "object") == unit:
+                return section
+    return None
+
+
+def per_day_per_object(section: Section, capacity: Optional[str], rooms: Optional[str]) -> Optional[float]:
+    """
+    price of the whole object for a night, None when the section has no price or the capacity/rooms are unknown
+    """
+    row = section.price()
+    if row is None:
+        return None
+    price = row[1]
+    nights = NIGHTS[section.period or "day"]
+    if nights != 1:
+        price /= nights
+    if section.unit == "person":
+        if not capacity:
+            return None
+        price *= int(capacity)
+    if section.unit == "room":
+        if not rooms:
+            return None
+        price *= int(rooms)
+    return price
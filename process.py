@@ -1,154 +1,320 @@
+import argparse
 import copy
 import csv
-import gzip
+import inspect
+import io
 import json
+import os
 import re
+import tempfile
+import time
 from collections import defaultdict
-from typing import Iterable, Dict, Any, List
-
-from utils import numeric_stats
-
-# global stats
-counters = defaultdict(int)
-ratings = []
-prices = []
-distances = {
-    "les": [],
-    "restaurace": [],
-    "obchod": [],
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Callable, DefaultDict, FrozenSet, Iterable, Iterator, Dict, Any, List, Tuple
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.json
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import pricelist
+import record
+import utils
+from dedup import DuplicateIndex, record_id, signature
+from filters import FILTERS_PATH, Rule, RecordColumns, TableColumns, evaluate, load_rules
+from journal import content_hash
+from metrics import METRICS, METRICS_DIR
+from pricelist import parse_pricelist, per_day_per_object, preferred_section
+from record import Property
+from record_cache import CACHE_PATH, RecordCache
+from storage import read_lines
+from utils import StreamingStats, bounded_map, numeric_stats
+
+# places with distance stats, each has a <place>_distance_m field in record.Property
+DISTANCE_PLACES = ["les", "restaurace", "obchod"]
+
+# crawl output (single file or shard manifest)
+PROPERTIES_PATH = "properties.json.gz"
+
+# records sent to a worker at once with --workers
+CHUNK_SIZE = 1000
+# records in one parquet row group
+PARQUET_BATCH = 2000
+# records the filter rules are evaluated on at once
+FILTER_BATCH = 1000
+
+# equipment features, a feature is present when any equipment item contains one of its (lowercase) substrings
+FEATURES = {
+    "internet": ["inter", "wi-fi", "wifi"],
+    "shared_room": ["společenská místnost"],
+    "parking": ["parko"],
+    "grill": ["gril"],
+    "sauna": ["saun"],
+    "pool": ["bazén"],
+    "fireplace": ["krb"],
+    "firepit": ["ohniště"],
+    "terrace": ["teras"],
+    "table_tennis": ["stolní tenis"],
+    "billiards": ["kulečník"],
+    "playground": ["dětské hřiště"],
+    "dishwasher": ["myčk"],
+    "washing_machine": ["pračk"],
+    "tv": ["televiz"],
 }
 
-# limits
-MIN_BEDS = 22
-MAX_BEDS = 42
-MIN_ROOMS = 7
-MAX_RESTAURANT_DISTANCE = 1500
-MAX_PRICE = 15000
-
 # regex
 distance_extractor = re.compile(r"(\d*[.,]?\d+)\s*(min|m|km)")
-price_extractor = re.compile(r"(\d+\.? ?\d+)\s?(?:,\-)?Kč")
+# one alternation over the whole vocabulary, the name of the matching group is the feature
+feature_extractor = re.compile("|".join(f"(?P<{name}>{'|'.join(map(re.escape, substrings))})"
+                                        for name, substrings in FEATURES.items()))
+
+
+# csv columns in front, the remaining record keys follow in the order they were first seen
+CSV_FIELDNAMES = [
+    "name",
+    "locality",
+    "capacity",
+    "rooms",
+    "price (per day per object)",
+    "homepage",
+    "url",
+    "breakfast",
+    "half-board",
+    "rating_mean",
+    "rating_median",
+    "rating_samples",
+    "les_distance_m",
+    "restaurace_distance_m",
+    "obchod_distance_m",
+    "features",
+    "filtered"
+]
+
+Stage = Callable[[Property, "Stats"], None]
+
+
+class Stats:
+    """
+    accumulated stats of one run, passed to every stage
+    """
+
+    def __init__(self, stages: Iterable[Stage] = ()):
+        self.records = 0
+        # counters of every stage separately, so the report lists them stage by stage
+        self.stage_counters: Dict[str, DefaultDict[str, int]] = {}
+        for stage in stages:
+            self.counter(stage)
+        self.ratings = StreamingStats()
+        self.prices = StreamingStats()
+        self.distances = {place: StreamingStats() for place in DISTANCE_PLACES}
+
+    def counter(self, stage: Stage) -> DefaultDict[str, int]:
+        return self.stage_counters.setdefault(stage.__name__, defaultdict(int))
+
+    @property
+    def counters(self) -> Dict[str, int]:
+        return {name: count for counters in self.stage_counters.values() for name, count in counters.items()}
+
+    def merge(self, other: "Stats") -> "Stats":
+        """
+        add the stats of the following chunk of records
+        """
+        self.records += other.records
+        for stage, counters in other.stage_counters.items():
+            merged = self.stage_counters.setdefault(stage, defaultdict(int))
+            for name, count in counters.items():
+                merged[name] += count
+        self.ratings.merge(other.ratings)
+        self.prices.merge(other.prices)
+        for place, samples in other.distances.items():
+            self.distances[place].merge(samples)
+        return self
+
+    def apply(self, delta: Dict[str, Any]):
+        """
+        add the stats a single record contributed (RecordStats.delta), in the order they were added
+        """
+        for stage, counters in delta["counters"].items():
+            merged = self.stage_counters.setdefault(stage, defaultdict(int))
+            for name, count in counters.items():
+                merged[name] += count
+        self.ratings.update(delta["ratings"])
+        self.prices.update(delta["prices"])
+        for place, values in delta["distances"].items():
+            self.distances[place].update(values)
+
+
+class Samples(list):
+    add = list.append
+    update = list.extend
+
+
+class RecordStats:
+    """
+    stats of enhancing a single record, the values are recorded instead of accumulated so they can be
+    cached with the record and applied to the stats of a later run
+    """
+
+    def __init__(self):
+        self.stage_counters: Dict[str, DefaultDict[str, int]] = {}
+        self.ratings = Samples()
+        self.prices = Samples()
+        self.distances = {place: Samples() for place in DISTANCE_PLACES}
+
+    counter = Stats.counter
 
+    def delta(self) -> Dict[str, Any]:
+        return {"counters": self.stage_counters, "ratings": self.ratings, "prices": self.prices,
+                "distances": {place: values for place, values in self.distances.items() if values}}
 
-def load_data() -> Iterable[Dict[str, Any]]:
-    with gzip.open("properties.json.gz") as f:
-        for line in f:
-            yield json.loads(line)
 
+def load_data(path: str = PROPERTIES_PATH) -> Iterable[Property]:
+    return map(record.decode, read_lines(path))
 
-def add_homepage(properties: Iterable[Dict[str, Any]]):
+
+def add_homepage(prop: Property, stats: Stats):
     """
     extract homepage link
     """
-    for i in properties:
-        i["contact_links"] = list(set(i.get("contact_links", [])) - {"#"})
-        links = [l for l in i.get("contact_links", []) if "face" not in l]
-        if len(links) == 1:
-            i["homepage"] = links[0]
-            counters["homepage_present"] += 1
-        elif len(links) > 1:
-            counters["too_many_links_for_homepage_detection"] += 1
+    counters = stats.counter(add_homepage)
+    # deduplicated in page order, a set would order the links differently in every interpreter
+    prop["contact_links"] = list(dict.fromkeys(l for l in prop.get("contact_links", []) if l != "#"))
+    links = [l for l in prop.get("contact_links", []) if "face" not in l]
+    if len(links) == 1:
+        prop["homepage"] = links[0]
+        counters["homepage_present"] += 1
+    elif len(links) > 1:
+        counters["too_many_links_for_homepage_detection"] += 1
+
+
+def counter_stats(stats: Stats):
+    ln = stats.records
+    for name, count in stats.counters.items():
+        print(f"{name} {count}/{ln}: {count / ln * 100:.2f}%")
 
 
-def counter_stats(properties: Iterable[Dict[str, Any]]):
-    ln = len(list(properties))
-    for name, count in counters.items():
-        print(f"{name} {count}/{ln}: {count / ln * 100:.2f}%")
+def distances_to_map(prop: Property, stats: Stats):
+    prop["distances_map"] = {i[0].lower(): i[1] for i in prop.get("distances", [])}
 
 
-def distances_to_map(properties: Iterable[Dict[str, Any]]):
-    for i in properties:
-        i["distances_map"] = {i[0].lower(): i[1] for i in i.get("distances", [])}
+def ratings_stats(prop: Property, stats: Stats):
+    ratings = prop.get("numeric_ratings", [])
+    if not ratings:
+        return
+    ratings = [int(j) for j in ratings]
+    prop["numeric_ratings"] = ratings
+    prop["rating_stats"] = numeric_stats(ratings)
+    stats.ratings.update(ratings)
+    stats.counter(ratings_stats)["rating_present"] += 1
 
 
-def ratings_stats(properties: Iterable[Dict[str, Any]]):
-    global ratings
-    for i in properties:
-        stats = i.get("numeric_ratings", [])
-        if not stats:
-            continue
-        stats = [int(j) for j in stats]
-        i["numeric_ratings"] = stats
-        i["rating_stats"] = numeric_stats(stats)
-        ratings += stats
-        counters["rating_present"] += 1
-
-
-def add_distances(properties: Iterable[Dict[str, Any]]):
-    for i in properties:
-        for place in distances.keys():
-            poi_dist = i.get("distances_map", {}).get(place)
-            if not poi_dist:
-                counters[f"distance_to_{place}_missing"] += 1
-                continue
-            counters[f"{place}_distance_present"] += 1
-            distance = extract_normalized_distance(poi_dist)
-            if distance == -1:
-                counters[f"distance_to_{place}_malformed"] += 1
-                continue
-            i[f"{place}_distance_m"] = distance
-            distances[place].append(distance)
-
-
-def extract_normalized_price(properties: Iterable[Dict[str, Any]]):
-    global prices
-    for prop in properties:
-        price_list = prop.get("pricelist", [])
-        if not price_list:
-            counters["pricelist_missing"] += 1
+def add_distances(prop: Property, stats: Stats):
+    counters = stats.counter(add_distances)
+    for place in DISTANCE_PLACES:
+        poi_dist = prop.get("distances_map", {}).get(place)
+        if not poi_dist:
+            counters[f"distance_to_{place}_missing"] += 1
             continue
-        # todo: this may be massively improved by iterating over the sections
-        price_header = price_list[0]
-        if "apartmán" in price_header:
-            prop["apartman"] = True
+        counters[f"{place}_distance_present"] += 1
+        distance = extract_normalized_distance(poi_dist)
+        if distance == -1:
+            counters[f"distance_to_{place}_malformed"] += 1
             continue
-        if "polop" in price_header:
-            prop["half-board"] = True
-            counters["half_board"] += 1
-        if "snídaní" in price_header:
-            prop["breakfast"] = True
-            counters["breakfast"] += 1
-        price = -1
-        for price_candidate in price_list[1:]:
-            if not (price_candidate.lower().startswith("let") or price_candidate.lower().startswith("mimo")):
-                continue
-            # There is no price in the first section (continue may be ok)
-            if price_candidate.lower().startswith("cen"):
-                break
-            price_search = price_extractor.search(price_candidate)
-            if not price_search:
+        prop[f"{place}_distance_m"] = distance
+        stats.distances[place].add(distance)
+
+
+def extract_normalized_price(prop: Property, stats: Stats):
+    counters = stats.counter(extract_normalized_price)
+    sections = parse_pricelist(prop.get("pricelist", []))
+    if not sections:
+        counters["pricelist_missing"] += 1
+        return
+    prop["price_sections"] = [section.to_dict() for section in sections]
+    # the flags describe the main (first) offer
+    first = sections[0]
+    if first.unit == "apartment":
+        prop["apartman"] = True
+        return
+    if first.board == "half_board":
+        prop["half-board"] = True
+        counters["half_board"] += 1
+    if first.board == "breakfast":
+        prop["breakfast"] = True
+        counters["breakfast"] += 1
+    for section in sections:
+        for row in section.unpriced:
+            if row.lower().startswith(("let", "mimo")):
                 counters["idiotic_price_format"] += 1
-                continue
-            price = int(price_search.group(1).replace('.', '').replace(' ', ''))
-            break
-        if price == -1:
-            counters["price_not_found"] += 1
-            continue
-        if "za týden" in price_header:
-            price /= 7
-        # todo: za vikend
-        # todo: when there is only prices per person we probably do not like the object (but we have to iterate all the price sections to determine this properly)
-        if "za osobu" in price_header:
-            if not prop.get("capacity"):
-                continue
-            price *= int(prop.get("capacity"))
-        if "pokoj" in price_header:
-            if not prop.get("rooms"):
-                continue
-            price *= int(prop.get("rooms"))
-        prop["price (per day per object)"] = round(price)
-        prices.append(price)
-
-
-def enhance(properties: Iterable[Dict[str, Any]]):
-    add_homepage(properties)
-    ratings_stats(properties)
-    distances_to_map(properties)
-    add_distances(properties)
-    extract_normalized_price(properties)
-
-
-def filter_out(reason: str, item: Dict[str, Any], soft: bool = False):
+    section = preferred_section(sections)
+    if section is None:
+        counters["price_not_found"] += 1
+        return
+    if section.unit == "person":
+        # no price for the whole object in any section
+        counters["price_per_person_only"] += 1
+    price = per_day_per_object(section, prop.get("capacity"), prop.get("rooms"))
+    if price is None:
+        return
+    prop["price (per day per object)"] = round(price)
+    stats.prices.add(price)
+
+
+@lru_cache(maxsize=65536)
+def item_features(item: str) -> FrozenSet[str]:
+    # the site uses a small fixed set of equipment names, so every distinct item is matched only once
+    return frozenset(m.lastgroup for m in feature_extractor.finditer(item.lower()))
+
+
+def equipment_features(equipment: Iterable[str]) -> List[str]:
+    """
+    features found in the equipment items in FEATURES order
+    """
+    found = frozenset().union(*map(item_features, filter(None, equipment)))
+    return [name for name in FEATURES if name in found]
+
+
+def add_features(prop: Property, stats: Stats):
+    prop["features"] = equipment_features(prop.get("equipment", []))
+
+
+def add_area(prop: Property, stats: Stats):
+    prop["area"] = prop.get("url").split('/')[3]
+
+
+ENHANCE_STAGES: List[Stage] = [add_homepage, ratings_stats, distances_to_map, add_distances, extract_normalized_price,
+                               add_features, add_area]
+
+# crawled fields the stages change, copied before enhancing a record for the cache so a change made in place is found,
+# a stage changing another crawled field has to add it here
+CHANGED_FIELDS = ["contact_links", "numeric_ratings"]
+
+
+def enhance(prop: Property, stats: Stats):
+    for stage in ENHANCE_STAGES:
+        with METRICS.stage("enhance." + stage.__name__):
+            stage(prop, stats)
+
+
+def enhance_version() -> str:
+    """
+    hash of the enhancement code and its configuration, cached records of another version are enhanced again
+    """
+    code = ENHANCE_STAGES + [enhance, extract_normalized_distance, item_features.__wrapped__, equipment_features,
+                             utils]
+    parts = [inspect.getsource(obj) for obj in code + [record]]
+    parts += [inspect.getsource(pricelist), distance_extractor.pattern, json.dumps(FEATURES),
+              json.dumps(DISTANCE_PLACES), json.dumps(CHANGED_FIELDS)]
+    return content_hash("\n".join(parts).encode("utf-8"))[:16]
+
+
+def filter_out(reason: str, item: Property, counters: DefaultDict[str, int], soft: bool = False):
     if soft:
         reason += "_soft"
     counters[f"filtered_{reason}"] += 1
@@ -179,124 +345,452 @@ def extract_normalized_distance(dist: str) -> float:
     return -1
 
 
-def is_equipment_present(wanted_equip: List[str], property: Dict[str, Any]):
-    for equip in property.get("equipment", []):
-        for wanted in wanted_equip:
-            if wanted in equip.lower():
-                return True
-    return False
+def filtering(batch: List[Property], stats: Stats, rules: List[Rule]):
+    """
+    apply the filter rules to a batch of records, the masks are computed column-wise for the whole batch
+    """
+    counters = stats.counter(filtering)
+    matches = np.column_stack(evaluate(rules, RecordColumns(batch))).tolist() if rules else [[]] * len(batch)
+    for prop, matched in zip(batch, matches):
+        if prop.get("GPS"):
+            counters["gps_present"] += 1
+        for rule, match in zip(rules, matched):
+            if match:
+                filter_out(rule.reason, prop, counters, rule.soft)
 
 
-def filtering(properties: Iterable[Dict[str, Any]]):
-    for i in properties:
-        if i.get("GPS"):
-            counters["gps_present"] += 1
-            # 16.6 (moved because of Beskydy)
-            if float(i.get("GPS").get("E")) > 19:
-                filter_out("too_much_east", i)
-        if i.get("apartman"):
-            filter_out("apartman", i)
-        capacity = int(i.get("capacity", -1))
-        if capacity == -1:
-            filter_out("capacity_missing", i)
-        elif capacity < MIN_BEDS:
-            filter_out(f"small_capacity_<{MIN_BEDS}", i)
-        elif capacity > MAX_BEDS:
-            filter_out(f"too_big_>{MAX_BEDS}", i)
-        rooms = i.get("rooms", -1)
-        if not rooms or rooms == -1:
-            filter_out("missing_rooms", i)
-        elif int(rooms) < MIN_ROOMS:
-            filter_out(f"not_enough_rooms_<{MIN_ROOMS}", i)
-        restaurant_dist = i.get("restaurace_distance_m", -1)
-        if restaurant_dist == -1:
-            filter_out("restaurant_distance_invalid", i, soft=True)
-        if restaurant_dist > MAX_RESTAURANT_DISTANCE:
-            filter_out(f"restaurant_distance_too_big_>{MAX_RESTAURANT_DISTANCE}", i, soft=True)
-        if not is_equipment_present(["inter", "wi-fi", "wifi"], i):
-            filter_out(f"no_internet", i)
-        if not is_equipment_present(["společenská místnost"], i):
-            filter_out(f"no_shared_room", i)
-        if not is_equipment_present(["parko"], i):
-            filter_out(f"no_parking", i)
-        if not is_equipment_present(["gril"], i):
-            filter_out(f"no_grill", i, soft=True)
-        price = i.get("price")
-        if price and int(price) > MAX_PRICE:
-            filter_out(f"expensive", i)
-        area = i.get("url").split('/')[3]
-        i["area"] = area
-        if area in {"jeseniky", "slovensko_chaty"}:
-            filter_out(f"blocklisted_area", i)
-
-    for i in properties:
-        if i.get("filtered", False):
-            counters["filtered"] += 1
-
-
-def store(properties, store_csv=True, store_json=True):
-    if store_csv:
-        fieldnames = [
-            "name",
-            "locality",
-            "capacity",
-            "rooms",
-            "price (per day per object)",
-            "homepage",
-            "url",
-            "breakfast",
-            "half-board",
-            "rating_mean",
-            "rating_median",
-            "rating_samples",
-            "les_distance_m",
-            "restaurace_distance_m",
-            "obchod_distance_m",
-            "filtered"
-        ]
-        all_fieldnames = set()
-        for prop in properties:
-            all_fieldnames |= set(prop.keys())
-        for fn in all_fieldnames:
-            if fn not in fieldnames:
-                fieldnames.append(fn)
-
-        with open('out.csv', 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-            writer.writeheader()
-            for csv_prop in properties:
-                prop = copy.deepcopy(csv_prop)
-                prop.pop("text")
-                rating = prop.get("rating_stats")
-                if rating:
-                    prop["rating_mean"] = rating.get("mean")
-                    prop["rating_median"] = rating.get("median")
-                    prop["rating_samples"] = rating.get("samples")
-                writer.writerow(prop)
-
-    if store_json:
-        def list_filtered_reasons(x):
-            for k, v in x.items():
-                if type(v) is set:
-                    x[k] = list(v)
-            return x
-        json.dump(list(map(list_filtered_reasons, properties)), open("out.json", 'w'))
+def count_filtered(prop: Property, stats: Stats):
+    if prop.get("filtered", False):
+        stats.counter(count_filtered)["filtered"] += 1
+
+
+def mark_duplicate(prop: Property, sig, duplicates: DuplicateIndex, stats: Stats):
+    canonical = duplicates.add(record_id(prop), sig)
+    if canonical:
+        prop["duplicate_of"] = canonical
+        stats.counter(mark_duplicate)["duplicate"] += 1
+
+
+STAGES: List[Stage] = ENHANCE_STAGES + [filtering, count_filtered, mark_duplicate]
+
+
+def enhanced(properties: Iterable[Property], stats: Stats) -> Iterator[Property]:
+    for prop in properties:
+        stats.records += 1
+        enhance(prop, stats)
+        yield prop
+
+
+def enhanced_cached(lines: Iterable[str], stats: Stats, cache: RecordCache) -> Iterator[Property]:
+    """
+    enhance only the records which are new or changed since they were cached, the others get the cached
+    fields and stats of their enhancement
+    """
+    new, seen = [], []
+    for line in lines:
+        key = content_hash(line.encode("utf-8"))
+        stats.records += 1
+        prop = record.decode(line)
+        cached = cache.get(key)
+        if cached:
+            with METRICS.stage("enhance.from_cache"):
+                fields, delta = cached
+                prop.update(json.loads(fields))
+                stats.apply(json.loads(delta))
+            seen.append(key)
+        else:
+            raw = dict(prop.items())
+            for field in CHANGED_FIELDS:
+                if field in raw:
+                    raw[field] = copy.deepcopy(raw[field])
+            record_stats = RecordStats()
+            enhance(prop, record_stats)
+            delta = record_stats.delta()
+            stats.apply(delta)
+            # only the added and changed fields are cached, updating the raw record with them keeps the key order
+            # of the enhanced record
+            fields = {k: v for k, v in prop.items() if k not in raw or raw[k] is not v and raw[k] != v}
+            new.append((key, json.dumps(fields), json.dumps(delta)))
+        if len(new) + len(seen) >= FILTER_BATCH:
+            cache.put(new)
+            cache.mark_seen(seen)
+            new, seen = [], []
+        yield prop
+    cache.put(new)
+    cache.mark_seen(seen)
+
+
+def filtered(records: Iterable[Property], stats: Stats, rules: List[Rule]) -> Iterator[Property]:
+    """
+    filter enhanced records in batches of FILTER_BATCH
+    """
+    records = iter(records)
+    for batch in iter(lambda: list(islice(records, FILTER_BATCH)), []):
+        with METRICS.stage("filtering", len(batch)):
+            filtering(batch, stats, rules)
+            for prop in batch:
+                count_filtered(prop, stats)
+        yield from batch
+
+
+def process(properties: Iterable[Property], stats: Stats, rules: List[Rule]) -> Iterator[Property]:
+    """
+    enhance the records one after another and filter them in batches of FILTER_BATCH,
+    only the current batch and the stats are kept in memory
+    """
+    return filtered(enhanced(properties, stats), stats, rules)
+
+
+def deduplicated(records: Iterable[Property], stats: Stats,
+                 duplicates: DuplicateIndex) -> Iterator[Property]:
+    """
+    mark records duplicating an earlier one with the canonical id of their cluster (duplicate_of)
+    """
+    for prop in records:
+        with METRICS.stage("dedup"):
+            mark_duplicate(prop, signature(prop), duplicates, stats)
+        yield prop
+
+
+def refilter(path: str, rules: List[Rule]) -> Stats:
+    """
+    evaluate the rules again on the enhanced records of a parquet output, reading only the columns the rules use,
+    and replace its filtered and filtered_reasons columns with the new result
+    """
+    fields = {rule.field.split(".")[0] for rule in rules} | {"GPS"}
+    names = [name for name in pyarrow.parquet.read_schema(path).names if name in fields]
+    columns = TableColumns(pyarrow.parquet.read_table(path, columns=names))
+    masks = evaluate(rules, columns)
+    stats = Stats(STAGES)
+    stats.records = len(columns)
+    counted = [("gps_present", ~columns.missing("GPS"))] + [(rule.counter, mask) for rule, mask in zip(rules, masks)]
+    # counters in the order they first occur, the same as in a full run
+    counters = stats.counter(filtering)
+    for _, _, name, mask in sorted((int(np.argmax(mask)), i, name, mask)
+                                   for i, (name, mask) in enumerate(counted) if mask.any()):
+        counters[name] += int(mask.sum())
+    hard = [mask for rule, mask in zip(rules, masks) if not rule.soft]
+    filtered = np.logical_or.reduce(hard) if hard else np.zeros(len(columns), dtype=bool)
+    if filtered.any():
+        stats.counter(count_filtered)["filtered"] += int(filtered.sum())
+    with METRICS.stage("store.write", len(columns)):
+        write_filtered(path, rules, masks, filtered)
+    return stats
+
+
+def write_filtered(path: str, rules: List[Rule], masks: List[np.ndarray], filtered: np.ndarray):
+    """
+    rewrite the parquet file row group by row group with the given filter result, like a full run the reasons
+    are sorted and both columns are null for a record which matched no rule
+    """
+    reasons = [rule.reason + "_soft" if rule.soft else rule.reason for rule in rules]
+    matched = np.column_stack(masks).tolist() if rules else [[]] * len(filtered)
+    filtered_reasons = [sorted({reason for reason, match in zip(reasons, row) if match}) or None for row in matched]
+    hard = [True if f else None for f in filtered.tolist()]
+    source = pyarrow.parquet.ParquetFile(path)
+    schema = source.schema_arrow
+    tmp_path = f"{path}.tmp"
+    offset = 0
+    with pyarrow.parquet.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+        for i in range(source.num_row_groups):
+            table = source.read_row_group(i)
+            rows = slice(offset, offset + table.num_rows)
+            offset += table.num_rows
+            for name, values in (("filtered_reasons", filtered_reasons[rows]), ("filtered", hard[rows])):
+                index = schema.get_field_index(name)
+                table = table.set_column(index, schema.field(index), pyarrow.array(values, schema.field(index).type))
+            writer.write_table(table)
+    source.close()
+    os.replace(tmp_path, path)
+
+
+def csv_row(prop: Property) -> Dict[str, Any]:
+    row = {k: v for k, v in prop.items() if k != "text"}
+    rating = row.get("rating_stats")
+    if rating:
+        row["rating_mean"] = rating.get("mean")
+        row["rating_median"] = rating.get("median")
+        row["rating_samples"] = rating.get("samples")
+    if "features" in row:
+        row["features"] = ", ".join(row["features"])
+    # spooled as JSON, containers are written in the form the csv module would write them
+    return {k: str(v) if isinstance(v, (list, tuple, dict)) else set_repr(v) if isinstance(v, set) else v
+            for k, v in row.items()}
+
+
+def set_repr(values: set) -> str:
+    # sorted, the iteration order of a set of strings changes with every interpreter
+    return "{" + ", ".join(map(repr, sorted(values))) + "}"
+
+
+# a record serialized for out.json and out.csv and its keys
+Encoded = Tuple[str, str, List[str]]
+
+
+@METRICS.timed("store.encode")
+def encode(prop: Property) -> Encoded:
+    return record.encode(prop), json.dumps(csv_row(prop)), list(prop)
+
+
+def process_chunk(lines: List[str], rules: List[Rule], cache_path: str = None,
+                  dedup: bool = True) -> Tuple[List[Property], list, Stats, tuple, dict]:
+    """
+    run all stages but the deduplication on a chunk of crawl output in a worker process, returns the records and
+    their MinHash signatures for the deduplication in the main process, their stats, the cache writes
+    (new entries, seen keys) for the main process and the metrics of the chunk
+    """
+    METRICS.reset()
+    stats = Stats(STAGES)
+    cache = RecordCache(cache_path, readonly=True) if cache_path else None
+    if cache:
+        records = list(filtered(enhanced_cached(lines, stats, cache), stats, rules))
+    else:
+        records = list(process(map(record.decode, lines), stats, rules))
+    signatures = []
+    for prop in records:
+        if dedup:
+            with METRICS.stage("dedup.signature"):
+                signatures.append(signature(prop))
+        else:
+            signatures.append(None)
+    if cache:
+        cache.close()
+        return records, signatures, stats, (cache.new, cache.seen), METRICS.snapshot()
+    return records, signatures, stats, ([], []), METRICS.snapshot()
+
+
+def process_parallel(path: str, stats: Stats, workers: int, rules: List[Rule], cache: RecordCache = None,
+                     duplicates: DuplicateIndex = None) -> Iterator[Encoded]:
+    """
+    process the input in chunks on a pool of `workers` processes, the records come back in input order
+    and the chunk stats are merged into `stats` in that order too, so everything is identical to a serial run
+    the workers only read the cache and compute the signatures, the cache writes, the deduplication across all
+    chunks and the serialization of the marked records are done here
+    """
+    lines = read_lines(path)
+    chunks = iter(lambda: list(islice(lines, CHUNK_SIZE)), [])
+    cache_path = cache.path if cache else None
+    dedup = duplicates is not None
+    with ProcessPoolExecutor(workers) as pool:
+        for records, signatures, chunk_stats, (new, seen), chunk_metrics in bounded_map(
+                pool, process_chunk, ((chunk, rules, cache_path, dedup) for chunk in chunks), workers * 2):
+            stats.merge(chunk_stats)
+            METRICS.merge(chunk_metrics)
+            if cache:
+                cache.put(new)
+                cache.mark_seen(seen)
+            for prop, sig in zip(records, signatures):
+                if dedup:
+                    with METRICS.stage("dedup"):
+                        mark_duplicate(prop, sig, duplicates, stats)
+                yield encode(prop)
+
+
+def parquet_schema() -> "pyarrow.Schema":
+    """
+    fixed columns of out.parquet, fields missing in a record are null (distances_map duplicates distances)
+    """
+    strings = pyarrow.list_(pyarrow.string())
+    pairs = pyarrow.list_(strings)
+    return pyarrow.schema([
+        ("url", pyarrow.string()),
+        ("id", pyarrow.string()),
+        ("name", pyarrow.string()),
+        ("locality", pyarrow.string()),
+        ("area", pyarrow.string()),
+        ("capacity", pyarrow.string()),
+        ("rooms", pyarrow.string()),
+        ("icons", strings),
+        ("contact_raw", pyarrow.string()),
+        ("contact_links", strings),
+        ("homepage", pyarrow.string()),
+        ("map_link", pyarrow.string()),
+        ("GPS", pyarrow.struct([("N", pyarrow.string()), ("E", pyarrow.string())])),
+        ("distances", pairs),
+        ("les_distance_m", pyarrow.float64()),
+        ("restaurace_distance_m", pyarrow.float64()),
+        ("obchod_distance_m", pyarrow.float64()),
+        ("equipment", strings),
+        ("features", strings),
+        ("ratings", strings),
+        ("numeric_ratings", pyarrow.list_(pyarrow.int64())),
+        ("rating_stats", pyarrow.struct([
+            ("max", pyarrow.int64()),
+            ("min", pyarrow.int64()),
+            ("mean", pyarrow.float64()),
+            ("median", pyarrow.float64()),
+            ("samples", pyarrow.int64()),
+            ("stdev", pyarrow.float64()),
+            ("max_diff", pyarrow.int64()),
+        ])),
+        ("place", pyarrow.string()),
+        ("pricelist", strings),
+        ("price_sections", pyarrow.list_(pyarrow.struct([
+            ("header", pyarrow.string()),
+            ("unit", pyarrow.string()),
+            ("period", pyarrow.string()),
+            ("board", pyarrow.string()),
+            ("prices", pyarrow.list_(pyarrow.struct([("season", pyarrow.string()), ("amount", pyarrow.int64())]))),
+        ]))),
+        ("price (per day per object)", pyarrow.int64()),
+        ("apartman", pyarrow.bool_()),
+        ("half-board", pyarrow.bool_()),
+        ("breakfast", pyarrow.bool_()),
+        ("images", pairs),
+        ("filtered_reasons", strings),
+        ("filtered", pyarrow.bool_()),
+        ("duplicate_of", pyarrow.string()),
+        ("text", pyarrow.string()),
+    ])
+
+
+class ParquetOutput:
+    """
+    columnar copy of out.json, every PARQUET_BATCH JSON lines are converted by arrow's json reader to a row group
+    """
+
+    def __init__(self, path: str):
+        if pyarrow is None:
+            raise RuntimeError("parquet output requires `pip install pyarrow`")
+        self.schema = parquet_schema()
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression="zstd")
+        self.batch: List[str] = []
+
+    def write(self, json_text: str):
+        self.batch.append(json_text)
+        if len(self.batch) >= PARQUET_BATCH:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        data = io.BytesIO("\n".join(self.batch).encode("utf-8"))
+        self.batch.clear()
+        table = pyarrow.json.read_json(
+            data, read_options=pyarrow.json.ReadOptions(block_size=1 << 26),
+            parse_options=pyarrow.json.ParseOptions(explicit_schema=self.schema, unexpected_field_behavior="ignore"))
+        self.writer.write_table(table.select(self.schema.names))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def store(properties: Iterable[Property], store_csv=True, store_json=True, parquet_path=None):
+    store_encoded(map(encode, properties), store_csv, store_json, parquet_path)
+
+
+def store_encoded(records: Iterable[Encoded], store_csv=True, store_json=True, parquet_path=None):
+    """
+    write out.csv, out.json (JSON lines) and optionally parquet in a single pass, csv rows are spooled
+    to a temporary file until all columns are known
+    """
+    fieldnames = list(CSV_FIELDNAMES)
+    known_fieldnames = set(fieldnames)
+    json_file = open("out.json", "w", encoding="utf-8") if store_json else None
+    parquet = ParquetOutput(parquet_path) if parquet_path else None
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as spool:
+        for json_text, csv_text, keys in records:
+            with METRICS.stage("store.write"):
+                if store_csv:
+                    for fn in keys:
+                        if fn not in known_fieldnames:
+                            known_fieldnames.add(fn)
+                            fieldnames.append(fn)
+                    spool.write(csv_text + "\n")
+                if store_json:
+                    json_file.write(json_text + "\n")
+                if parquet:
+                    parquet.write(json_text)
+
+        with METRICS.stage("store.write", 0):
+            if store_json:
+                json_file.close()
+            if parquet:
+                parquet.close()
+
+        if store_csv:
+            spool.seek(0)
+            with open('out.csv', 'w', newline='') as csvfile, METRICS.stage("store.csv", 0) as timer:
+                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+
+                writer.writeheader()
+                for line in spool:
+                    writer.writerow(json.loads(line))
+                    timer.items += 1
+
+
+def write_metrics(run: str, stats: Stats, directory: str):
+    METRICS.count("records", stats.records)
+    for name, count in stats.counters.items():
+        METRICS.count(name, count)
+    report = METRICS.write(run, directory)
+    print(f"\n{run} took {report['seconds']:.2f}s, peak memory {report['peak_rss_mb']:.0f} MB, "
+          f"report in {directory}/{run}.json")
 
 
 def main():
-    properties = list(load_data())
-    enhance(properties)
-    filtering(properties)
+    parser = argparse.ArgumentParser(description="enhance and filter the crawled properties into out.csv and out.json")
+    parser.add_argument("--input", default=PROPERTIES_PATH, help="crawl output (single file or shard manifest)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="process chunks of records on a pool of N processes (0 = in this process)")
+    parser.add_argument("--parquet", nargs="?", const="out.parquet",
+                        help="also write the records with a fixed schema to a parquet file (default out.parquet)")
+    parser.add_argument("--filters", default=FILTERS_PATH, help="filter rules")
+    parser.add_argument("--refilter", nargs="?", const="out.parquet", metavar="PARQUET",
+                        help="only apply the filter rules again to a --parquet output, rewrite its filtered and "
+                             "filtered_reasons columns and report the filter counters")
+    parser.add_argument("--cache", default=CACHE_PATH,
+                        help="cache of enhanced records, only new and changed records are enhanced again")
+    parser.add_argument("--no-cache", action="store_true", help="enhance all records and do not update the cache")
+    parser.add_argument("--no-dedup", action="store_true", help="do not mark near-duplicate listings")
+    parser.add_argument("--metrics", default=METRICS_DIR, help="directory of the run report and Prometheus textfile")
+    parser.add_argument("--profile", metavar="STAGE",
+                        help="cProfile a stage of the main process (e.g. enhance.add_features, filtering, store.csv)")
+    args = parser.parse_args()
+    METRICS.profile(args.profile)
+    if (args.parquet or args.refilter) and pyarrow is None:
+        parser.error("parquet requires `pip install pyarrow`")
+    rules = load_rules(args.filters)
+
+    if args.refilter:
+        start = time.monotonic()
+        stats = refilter(args.refilter, rules)
+        counter_stats(stats)
+        print(f"\nrefiltered {stats.records} records in {time.monotonic() - start:.2f}s")
+        METRICS.add("refilter", time.monotonic() - start, stats.records)
+        write_metrics("refilter", stats, args.metrics)
+        return
+
+    stats = Stats(STAGES)
+    cache = None if args.no_cache else RecordCache(args.cache, enhance_version())
+    duplicates = None if args.no_dedup else DuplicateIndex()
+    if args.workers > 0:
+        records = process_parallel(args.input, stats, args.workers, rules, cache, duplicates)
+        store_encoded(records, parquet_path=args.parquet)
+    else:
+        if cache:
+            properties = filtered(enhanced_cached(read_lines(args.input), stats, cache), stats, rules)
+        else:
+            properties = process(load_data(args.input), stats, rules)
+        if duplicates is not None:
+            properties = deduplicated(properties, stats, duplicates)
+        store(properties, parquet_path=args.parquet)
+    if cache:
+        evicted = cache.evict()
+        cache.close()
     print()
-    print(f"global ratings stats: {numeric_stats(ratings)}")
-    print(f"prices stats: {numeric_stats(prices)}")
+    print(f"global ratings stats: {stats.ratings.stats()}")
+    print(f"prices stats: {stats.prices.stats()}")
     print()
-    for name, samples in distances.items():
-        print(f"distance to {name} stats: {numeric_stats(samples)}")
+    for name, samples in stats.distances.items():
+        print(f"distance to {name} stats: {samples.stats()}")
     print()
-    counter_stats(properties)
-    store(properties)
+    counter_stats(stats)
+    if cache:
+        print(f"\nenhanced {cache.stored} records, {stats.records - cache.stored} from the cache, "
+              f"evicted {evicted} from the cache")
+    write_metrics("process", stats, args.metrics)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,21 @@
+import argparse
+import asyncio
+import hashlib
+import time
+from typing import Annotated
+
+import msgspec
 import ollama
-import json
 
 import urllib.parse
 import os
 from pathlib import Path
 
+import record
+from metrics import METRICS
+from ratings_store import RatingsStore, rater_id
+from storage import read_lines
+
 OBJECTS_JSON_PATH = "out.json"
 INCLUDE_IMAGES = False
 # model="llama3",
@@ -16,7 +27,20 @@ INCLUDE_IMAGES = False
 MODEL = "llama3.2"
 # MODEL = "gemma2"
 
+# merge_ratings.py averages the ratings of ratings_store.AGGREGATED_PROMPTS, add a new version there,
+# v4 (--prompts v4) rates like v3 with fewer prompt tokens evaluated
 PROMPT_VERSION = "v3"
+# seconds a generate request may take
+TIMEOUT = 600
+# how long the server keeps the model (and the evaluated prompt prefix) loaded between requests
+KEEP_ALIVE = "30m"
+# seconds unloading a model in a sweep may take
+UNLOAD_TIMEOUT = 60
+# failed ratings are retried at the end of the run, after a pause doubling from RETRY_BACKOFF seconds every round
+RETRY_ROUNDS = 3
+RETRY_BACKOFF = 5.0
+# v4 is v3 with the rated property at the end, everything before it is the same for every property,
+# so the server evaluates it once per slot and reuses it from its cache for the following prompts
 PROMPTS = {
     "v2": """"
 I want to go to organize an event for more then 25 of my friends. 
@@ -34,13 +58,13 @@ Make sure to take the visitor reviews with a grain of salt mainly when there is
 We already visited the following 2 accommodations with my friends and we really liked it.
 
 The structured description of the first accommodation follows:
-{}
+{first}
 
 The structured description of the second accommodation follows:
-{}
+{second}
 
 The structured description of the accommodation which should be rated follows:
-{}
+{property}
 
 Your task is to rate the described object based on our requirements in json format containing the following fields (and only that):
 * "rating": which is a number between 0 and 1 where 1 means very suitable object for the event.
@@ -48,7 +72,7 @@ Your task is to rate the described object based on our requirements in json form
 * "owner_in_house": boolean, if the owner is present in the house which may be mentioned in the equipment or visitor reviews.
 * "explanation": Explain the motivation for the rating.
 
-{}
+{images}
 Make sure to reply with only the valid JSON and nothing more and only in english!
 """,
     "v3": """"
@@ -68,13 +92,13 @@ Make sure to take the visitor reviews with a grain of salt mainly when there is
 We already visited the following 2 accommodations with my friends and we really liked it.
 
 The structured description of the first accommodation follows:
-{}
+{first}
 
 The structured description of the second accommodation follows:
-{}
+{second}
 
 The structured description of the accommodation which should be rated follows:
-{}
+{property}
 
 Your task is to rate the described object based on our requirements in json format containing the following fields (and only that):
 * "rating": which is a number between 0 and 1 where 1 means very suitable object for the event.
@@ -82,12 +106,59 @@ Your task is to rate the described object based on our requirements in json form
 * "owner_in_house": boolean, if the owner is present in the house which may be mentioned in the equipment or visitor reviews.
 * "explanation": Explain the motivation for the rating.
 
-{}
+{images}
+Make sure to reply with only the valid JSON and nothing more and only in english!
+""",
+    "v4": """"
+I want to organize an event for more then 25 of my friends. 
+Anything with lower capacity would need to be really amazing for us to consider. In general capacity around 30 places is ideal because we have more flexibility.
+We are looking for accommodation and we needs something with a nice common room to play board games, therefore we need many chairs and tables. 
+We prefer not to have more than 5 people in one room.
+We also love PC games so we need a place where to put the desktops and ideally a good internet connection.
+Places where the owner stays with us are probably not great because we have long nights and that may be uncomfortable for the owner. So places like guesthouses (penzion in Czech) are not great.
+Also apartments are a no-go for us we need to rent the whole property.
+We do not care about winter amenities because our event is happening in September.
+
+The descriptions I will provide will be in Czech but always reply in English.
+
+Make sure to take the visitor reviews with a grain of salt mainly when there is not enough of them.
+
+We already visited the following 2 accommodations with my friends and we really liked it.
+
+The structured description of the first accommodation follows:
+{first}
+
+The structured description of the second accommodation follows:
+{second}
+
+Your task is to rate the accommodation described at the end based on our requirements in json format containing the following fields (and only that):
+* "rating": which is a number between 0 and 1 where 1 means very suitable object for the event.
+* "description": max one sentence description for the object. Examples: "Fancy wooden cottage with sauna.", "Moldy dump."
+* "owner_in_house": boolean, if the owner is present in the house which may be mentioned in the equipment or visitor reviews.
+* "explanation": Explain the motivation for the rating.
+
+{images}
 Make sure to reply with only the valid JSON and nothing more and only in english!
+
+The structured description of the accommodation which should be rated follows:
+{property}
 """,
 }
 
 
+# the reply the prompts ask for, sent to ollama as the JSON schema the generated output is constrained to
+# (a docstring would end up in the schema)
+class Rating(msgspec.Struct):
+    rating: Annotated[float, msgspec.Meta(ge=0, le=1)]
+    description: str
+    owner_in_house: bool
+    explanation: str
+
+
+RATING_SCHEMA = msgspec.json.schema_components([Rating])[1]["Rating"]
+rating_decoder = msgspec.json.Decoder(Rating)
+
+
 #
 
 def format_property(p):
@@ -103,6 +174,7 @@ def format_property(p):
     # map_link 	 https://ww...
     # distances 	 [['autobus...
     # equipment 	 ['Možnost ...
+    # features 	 ['internet...
     # ratings 	 ['Jaro 202...
     # numeric_ratings 	 [100, 100,...
     # place 	 Pecka - da...
@@ -130,8 +202,9 @@ Capacity: {p["capacity"]}
 Rooms: {p["rooms"]}
 Features: {','.join(p["icons"])}
 Equipment: {','.join(p["equipment"])}
+Key equipment: {', '.join(f.replace("_", " ") for f in p.get("features", []))}
 Price: {p.get("price (per day per object)", 0)}
-Bad features: {','.join(p.get("filtered_reasons", []))}
+Bad features: {','.join(sorted(p.get("filtered_reasons", [])))}
 Description: {p["text"].replace("\r\n", " ").replace("\n", " ").split("Kontakt na pronajímatele nebo provozovatele")[0].split("kontakty  mapa")[1].strip()}
 Visitor reviews: 
 {'\n'.join(ratings)}
@@ -139,7 +212,7 @@ Visitor reviews:
 
 
 def load_objects():
-    return json.load(open(OBJECTS_JSON_PATH))
+    return [record.decode(line) for line in read_lines(OBJECTS_JSON_PATH)]
 
 
 def find_by_name(name, properties):
@@ -148,7 +221,243 @@ def find_by_name(name, properties):
             return p
 
 
+def rated_listings(properties):
+    """
+    the same chalet listed again is rated once, under its first listing which is not filtered, that is a duplicate
+    when the canonical listing of its cluster is filtered out
+    """
+    clusters = set()
+    listings = []
+    for p in properties:
+        # duplicate_of is the dedup.record_id of the canonical listing
+        cluster = p.get("duplicate_of") or p.get("id") or p["url"]
+        if cluster not in clusters:
+            clusters.add(cluster)
+            listings.append(p)
+    return listings
+
+
+def rating_prompt(p, descriptions, prompt_version):
+    first, second = descriptions
+    return PROMPTS[prompt_version].format(
+        first=first, second=second, property=format_property(p),
+        images="Do not forget to use attached images of the accommodation for the analysis.\n" if INCLUDE_IMAGES else "")
+
+
+def image_paths(p):
+    if not INCLUDE_IMAGES:
+        return []
+    return [os.path.abspath(os.path.join("imgs", urllib.parse.quote(i[1], safe=''))) for i in p["images"]]
+
+
+def prompt_hash(model, prompt, images):
+    return hashlib.sha256("\0".join([model, prompt, *images]).encode("utf-8")).hexdigest()
+
+
+def parse_rating(text):
+    """
+    the validated rating as stored, raises msgspec.ValidationError (or DecodeError), the object is taken from between
+    the outermost braces for the responses generated without the schema (e.g. in a ```json block)
+    """
+    start, end = text.find("{"), text.rfind("}")
+    return msgspec.to_builtins(rating_decoder.decode(text[start:end + 1] if 0 <= start < end else text))
+
+
+async def generate_ratings(client, model, todo, parallel, timeout):
+    """
+    `parallel` workers take the (property, prompt, ...) entries from a queue, so up to `parallel` generate requests
+    are in flight, yields (entry, response or the exception it failed with) in the order of `todo`, a request taking
+    over `timeout` seconds fails
+    """
+    entries = asyncio.Queue()
+    for item in enumerate(todo):
+        entries.put_nowait(item)
+    results = asyncio.Queue()
+
+    async def worker():
+        while True:
+            i, (p, prompt, *_) = await entries.get()
+            start = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(
+                    client.generate(model=model, prompt=prompt, images=image_paths(p), format=RATING_SCHEMA,
+                                    keep_alive=KEEP_ALIVE), timeout)
+                METRICS.add("llm", time.perf_counter() - start)
+            except Exception as e:
+                response = e
+            results.put_nowait((i, response))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(parallel, len(todo)))]
+    # responses which came before the one of an earlier entry
+    early = {}
+    try:
+        for i, entry in enumerate(todo):
+            while i not in early:
+                j, response = await results.get()
+                early[j] = response
+            yield entry, early.pop(i)
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+def cached_rating(store, key):
+    cached = store.response(key)
+    if cached is None:
+        return None
+    try:
+        return parse_rating(cached)
+    except msgspec.MsgspecError:
+        # generated before the schema, generated again
+        return None
+
+
+async def generate_into(store, client, model, todo, parallel, timeout, result_id):
+    """
+    generates, validates and puts the ratings of `todo`, yields every entry with whether it was rated,
+    the failed ones are queued for a retry
+    """
+    async for entry, response in generate_ratings(client, model, todo, parallel, timeout):
+        p, _, key = entry
+        print(p["name"], p["url"])
+        # print(response["response"])
+        try:
+            if isinstance(response, Exception):
+                raise response
+            METRICS.count("llm_prompt_tokens", response.get("prompt_eval_count") or 0)
+            METRICS.count("llm_response_tokens", response.get("eval_count") or 0)
+            rating = parse_rating(response["response"])
+            print(rating)
+            # print("---")
+
+            store.put(p["id"], result_id, rating)
+            store.put_response(key, model, response["response"])
+            rated = True
+        except Exception as e:
+            attempts = store.fail(p["id"], result_id, repr(e))
+            print(f"rating failed ({e!r}), attempt {attempts}, queued for a retry")
+            METRICS.count("rating_failed")
+            rated = False
+        yield entry, rated
+
+
+async def rate(properties, store, descriptions, client, model, prompt_version, parallel, timeout):
+    """
+    rate the properties not rated by (`model`, `prompt_version`) yet, `descriptions` are the formatted references,
+    returns the number of ratings generated by the model (not taken from the prompt cache)
+    """
+    result_id = rater_id(model, prompt_version)
+    rated = store.rated(result_id)
+    # failed in an earlier run, retried with the failures of this one
+    queued = store.retries(result_id)
+    processed = 0
+    rated_by_llm = 0
+    todo = []
+    retries = []
+    for p in properties:
+        if p["id"] in rated:
+            print(p["name"], p["url"])
+            print(f"already rated with {model} and prompt {prompt_version} skip")
+            METRICS.count("already_rated")
+        else:
+            prompt = rating_prompt(p, descriptions, prompt_version)
+            key = prompt_hash(model, prompt, image_paths(p))
+            rating = cached_rating(store, key)
+            if rating is None:
+                (retries if p["id"] in queued else todo).append((p, prompt, key))
+                continue
+            # the same prompt was rated before, e.g. under another property id or prompt version name
+            print(p["name"], p["url"])
+            print("rated from the prompt cache")
+            store.put(p["id"], result_id, rating)
+            METRICS.count("prompt_cache_hits")
+        processed += 1
+        print(f"{processed}/{len(properties)}")
+
+    # this call's share of the llm metrics
+    calls, tokens = METRICS.stages.get("llm", [0.0, 0, 0])[1], METRICS.counters.get("llm_prompt_tokens", 0)
+    for retry in range(RETRY_ROUNDS + 1):
+        if retry:
+            todo, retries = retries, []
+            if not todo:
+                break
+            pause = RETRY_BACKOFF * 2 ** (retry - 1)
+            print(f"\nretrying {len(todo)} failed ratings in {pause:g}s, round {retry}/{RETRY_ROUNDS}")
+            await asyncio.sleep(pause)
+            METRICS.count("rating_retried", len(todo))
+        async for entry, ok in generate_into(store, client, model, todo, parallel, timeout, result_id):
+            if ok:
+                processed += 1
+                rated_by_llm += 1
+                print(f"{processed}/{len(properties)}")
+            else:
+                retries.append(entry)
+
+    # a generation per llm call, prompt_eval_count leaves out the prompt prefix the server reused from its cache
+    generated = METRICS.stages.get("llm", [0.0, 0, 0])[1] - calls
+    if generated:
+        print(f"\n{generated} ratings generated with {model} and prompt {prompt_version}, "
+              f"{(METRICS.counters['llm_prompt_tokens'] - tokens) / generated:.0f} prompt tokens evaluated per rating")
+    if retries:
+        print(f"{len(retries)} ratings still failing, kept in the retry queue for the next run")
+    return rated_by_llm
+
+
+async def sweep(properties, store, references, models, prompt_versions, parallel, timeout, host):
+    """
+    rate with every (model, prompt version) of the matrix, the missing ratings of a model are generated together so
+    every model is loaded once, the models with nothing missing are not loaded at all; an interrupted sweep is
+    resumed by running it again; `references` are the reference properties by the name they were looked up by
+    """
+    ids = {p["id"] for p in properties}
+    plan = {model: {version: len(ids - store.rated(rater_id(model, version))) for version in prompt_versions}
+            for model in models}
+    for model, missing in plan.items():
+        print(f"{model}: " + ", ".join(f"{n} missing with prompt {version}" for version, n in missing.items()))
+    plan = {model: missing for model, missing in plan.items() if any(missing.values())}
+    if not plan:
+        return
+    not_found = [name for name, reference in references.items() if reference is None]
+    if not_found:
+        raise ValueError(f"reference properties {', '.join(not_found)} not found among the unfiltered properties "
+                         f"of {OBJECTS_JSON_PATH}")
+
+    client = ollama.AsyncClient(host=host)
+    # the same for every prompt
+    descriptions = [format_property(r) for r in references.values()]
+    for i, (model, missing) in enumerate(plan.items()):
+        with METRICS.stage(f"sweep.{model}", 0) as timer:
+            for version, n in missing.items():
+                if n:
+                    timer.items += await rate(properties, store, descriptions, client, model, version, parallel,
+                                              timeout)
+            if i + 1 < len(plan):
+                # free the memory for the next model instead of waiting for KEEP_ALIVE, the next model is loaded anyway
+                try:
+                    await asyncio.wait_for(client.generate(model=model, keep_alive=0), UNLOAD_TIMEOUT)
+                except Exception as e:
+                    print(f"unloading {model} failed ({e!r})")
+                    METRICS.count("unload_failed")
+
+    if len(models) > 1 or len(prompt_versions) > 1:
+        print()
+        for model in plan:
+            seconds, _, rated = METRICS.stages[f"sweep.{model}"]
+            print(f"{model}: {rated} ratings generated in {seconds:.0f}s, {rated / (seconds or 1) * 60:.1f} per minute")
+
+
 def main():
+    parser = argparse.ArgumentParser(description=f"rate the properties in {OBJECTS_JSON_PATH} with ollama models")
+    parser.add_argument("--parallel", type=int, default=1, help="generate requests kept in flight")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help="seconds per generate request")
+    parser.add_argument("--host", help="ollama server (default $OLLAMA_HOST or http://127.0.0.1:11434), "
+                                       "e.g. a mock_ollama.py server")
+    parser.add_argument("--models", nargs="+", default=[MODEL], metavar="MODEL",
+                        help="rate with every model and every prompt version (a sweep), one model loaded at a time")
+    parser.add_argument("--prompts", nargs="+", default=[PROMPT_VERSION], choices=PROMPTS, metavar="VERSION",
+                        help=f"prompt versions, {', '.join(PROMPTS)} (default {PROMPT_VERSION})")
+    args = parser.parse_args()
+
     properties = load_objects()
 
     print(f"loaded {len(properties)} objects")
@@ -156,8 +465,12 @@ def main():
     properties = [p for p in properties if not p.get("filtered", False)]
     print(f"filtered to {len(properties)} objects")
 
-    simia = find_by_name("chalupa simia", properties)
-    centrum_slapy = find_by_name("drevníky resort slapy", properties)
+    # any listing of a reference will do, in the order they are described in the prompt
+    references = {name: find_by_name(name, properties) for name in ("drevníky resort slapy", "chalupa simia")}
+
+    listings = rated_listings(properties)
+    print(f"skipped {len(properties) - len(listings)} duplicate listings")
+    properties = listings
 
     # prompt = PROMPT.format(format_property(simia))
     #
@@ -181,55 +494,16 @@ def main():
     #
     # print(json.loads(response["response"].replace("```", "").replace("json", "")))
 
-    processed = 0
-
-    ratings = json.load(open("ratings.json"))
-
-    for p in properties:
-        print(p["name"], p["url"])
-
-        result_id = f"{MODEL}_{PROMPT_VERSION}"
+    store = RatingsStore()
 
-        present_ratings = ratings.get(p["id"], {})
-        if result_id in present_ratings:
-            print(f"already rated with {MODEL} and prompt {PROMPT_VERSION} skip")
-            processed += 1
-            print(f"{processed}/{len(properties)}")
-            continue
+    asyncio.run(sweep(properties, store, references, args.models, args.prompts, args.parallel, args.timeout,
+                      args.host))
 
-        prompt = PROMPTS[PROMPT_VERSION].format(
-            format_property(centrum_slapy), format_property(simia), format_property(p),
-            "Do not forget to use attached images of the accommodation for the analysis.\n" if INCLUDE_IMAGES else "")
-        # print(prompt)
-
-        images = []
-        if INCLUDE_IMAGES:
-            images = [os.path.abspath(os.path.join("imgs", urllib.parse.quote(i[1], safe=''))) for i in p["images"]]
-
-        response = ollama.generate(
-            model=MODEL,
-            prompt=prompt,
-            images=images,
-        )
-
-        # print(response["response"])
-        try:
-            rating = json.loads(response["response"].replace("```", "").replace("json", "").strip())
-            print(rating)
-            # print("---")
-
-            present_ratings[result_id] = rating
-            ratings[p["id"]] = present_ratings
-        except:
-            print(f"rating failed")
-
-        processed += 1
-        # if processed > 2:
-        #     break
-
-        print(f"{processed}/{len(properties)}")
+    # ratings.json for merge_ratings.py and anyone reading the ratings without the store
+    store.export()
+    store.close()
 
-        json.dump(ratings, open("ratings.json", "w"))
+    METRICS.write("rank")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,180 @@
+"""
+ratings of the properties by the LLM raters (<model>_<prompt version>) and the manual raters in sqlite, every rating
+is written on its own instead of rewriting ratings.json, with the generated responses cached by prompt and the
+failed ratings queued for a retry, run `python3 ratings_store.py --help` to export or compact
+"""
+import argparse
+import json
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+RATINGS_DB = "ratings.sqlite"
+# the exported ratings, {property id: {rater: rating}}
+RATINGS_PATH = "ratings.json"
+
+
+# prompt versions of the LLM raters merge_ratings.py averages into ratings_*, oldest first, v4 is v3 with the rated
+# property last
+AGGREGATED_PROMPTS = ["v3", "v4"]
+# LLM models left out of the average under every prompt version
+EXCLUDED_MODELS = ["llama3.2"]
+
+
+def rater_id(model: str, prompt_version: str) -> str:
+    return f"{model}_{prompt_version}"
+
+
+def aggregated(raters: Iterable[str]) -> Set[str]:
+    """
+    the raters of a property merge_ratings.py averages, one per model, the one of the latest aggregated prompt
+    version, so a model rating a property under v3 and v4 is counted once
+    """
+    latest = {}
+    for rater in raters:
+        model, _, version = rater.rpartition("_")
+        if version not in AGGREGATED_PROMPTS or model in EXCLUDED_MODELS:
+            continue
+        if model not in latest or AGGREGATED_PROMPTS.index(version) > AGGREGATED_PROMPTS.index(latest[model]):
+            latest[model] = version
+    return {rater_id(model, version) for model, version in latest.items()}
+
+
+class RatingsStore:
+    """
+    (property id, rater) -> rating as JSON, a new store starts with the ratings of `import_path` if it exists,
+    every put is committed at once so an interrupted run keeps all ratings written before
+    """
+
+    def __init__(self, path: str = RATINGS_DB, import_path: str = RATINGS_PATH):
+        self.path = path
+        new = not os.path.exists(path)
+        self.db = sqlite3.connect(path)
+        # an append to the log per rating, rank.py can be stopped and resumed at any time
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # seq keeps the order in which the raters first rated a property, a VACUUM may renumber plain rowids
+        self.db.execute("CREATE TABLE IF NOT EXISTS ratings "
+                        "(seq INTEGER PRIMARY KEY, property TEXT, rater TEXT, rating TEXT, UNIQUE (property, rater))")
+        # generated responses by the hash of the model and the whole prompt
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (hash TEXT PRIMARY KEY, model TEXT, response TEXT)")
+        # ratings which failed (timeout, invalid response), retried until they are put
+        self.db.execute("CREATE TABLE IF NOT EXISTS retries "
+                        "(property TEXT, rater TEXT, attempts INTEGER, error TEXT, PRIMARY KEY (property, rater))")
+        if new and import_path and os.path.exists(import_path):
+            self.import_json(import_path)
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM ratings").fetchone()[0]
+
+    def has(self, property_id: str, rater: str) -> bool:
+        return self.db.execute("SELECT 1 FROM ratings WHERE property = ? AND rater = ?",
+                               (property_id, rater)).fetchone() is not None
+
+    def rated(self, rater: str) -> Set[str]:
+        """
+        ids of the properties rated by `rater`
+        """
+        return {row[0] for row in self.db.execute("SELECT property FROM ratings WHERE rater = ?", (rater,))}
+
+    def get(self, property_id: str) -> Dict[str, Any]:
+        return {rater: json.loads(rating) for rater, rating in self.db.execute(
+            "SELECT rater, rating FROM ratings WHERE property = ? ORDER BY seq", (property_id,))}
+
+    def put(self, property_id: str, rater: str, rating: Any):
+        self.put_many([(property_id, rater, rating)])
+
+    def put_many(self, entries: Iterable[Tuple[str, str, Any]]):
+        entries = [(prop, rater, json.dumps(rating)) for prop, rater, rating in entries]
+        # an update keeps the seq, so the export keeps the order in which the raters first rated a property
+        with self.db:
+            self.db.executemany("INSERT INTO ratings (property, rater, rating) VALUES (?, ?, ?) "
+                                "ON CONFLICT (property, rater) "
+                                "DO UPDATE SET rating = excluded.rating", entries)
+            self.db.executemany("DELETE FROM retries WHERE property = ? AND rater = ?",
+                                ((prop, rater) for prop, rater, _ in entries))
+
+    def fail(self, property_id: str, rater: str, error: str) -> int:
+        """
+        queue a failed rating for a retry, returns how many times it failed
+        """
+        with self.db:
+            return self.db.execute("INSERT INTO retries VALUES (?, ?, 1, ?) ON CONFLICT (property, rater) "
+                                   "DO UPDATE SET attempts = attempts + 1, error = excluded.error RETURNING attempts",
+                                   (property_id, rater, error)).fetchone()[0]
+
+    def retries(self, rater: str) -> Dict[str, int]:
+        """
+        property id -> failed attempts of the ratings by `rater` waiting for a retry
+        """
+        return dict(self.db.execute("SELECT property, attempts FROM retries WHERE rater = ? ORDER BY rowid", (rater,)))
+
+    def response(self, prompt_hash: str) -> Optional[str]:
+        row = self.db.execute("SELECT response FROM responses WHERE hash = ?", (prompt_hash,)).fetchone()
+        return row[0] if row else None
+
+    def put_response(self, prompt_hash: str, model: str, response: str):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (prompt_hash, model, response))
+
+    def import_json(self, path: str):
+        """
+        add the ratings of a file in the ratings.json shape, replacing stored ratings of the same raters
+        """
+        with open(path, encoding="utf-8") as f:
+            self.put_many((prop, rater, rating) for prop, ratings in json.load(f).items()
+                          for rater, rating in ratings.items())
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        """
+        all ratings in the ratings.json shape, properties and raters in the order they were first rated
+        """
+        ratings: Dict[str, Dict[str, Any]] = {}
+        for prop, rater, rating in self.db.execute("SELECT property, rater, rating FROM ratings ORDER BY seq"):
+            ratings.setdefault(prop, {})[rater] = json.loads(rating)
+        return ratings
+
+    def export(self, path: str = RATINGS_PATH):
+        """
+        write the ratings.json shape atomically, a crash leaves the previous export intact
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    def compact(self):
+        """
+        fold the write-ahead log into the database and reclaim the space of replaced ratings
+        """
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.db.execute("VACUUM")
+
+    def close(self):
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"export, import or compact the ratings in {RATINGS_DB}")
+    parser.add_argument("--db", default=RATINGS_DB)
+    parser.add_argument("--import", dest="import_path", metavar="JSON",
+                        help="add the ratings of a ratings.json file, replacing stored ratings of the same rater")
+    parser.add_argument("--export", nargs="?", const=RATINGS_PATH, metavar="JSON",
+                        help=f"write all ratings in the ratings.json shape (default {RATINGS_PATH})")
+    parser.add_argument("--compact", action="store_true", help="checkpoint the log and vacuum the database")
+    args = parser.parse_args()
+
+    store = RatingsStore(args.db, import_path=None)
+    if args.import_path:
+        store.import_json(args.import_path)
+    if args.compact:
+        store.compact()
+    if args.export:
+        store.export(args.export)
+    print(f"{len(store)} ratings in {args.db}, "
+          f"{store.db.execute('SELECT count(*) FROM retries').fetchone()[0]} failed ratings waiting for a retry")
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+typed property record shared by download.py, process.py and rank.py: the fields parse_property crawls and the
+fields process.py adds, decoded with msgspec into a struct instead of a dict, the page `text` stays encoded JSON
+until it is read and is written back without being decoded at all
+"""
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import msgspec
+from msgspec import UNSET, UnsetType
+
+
+class Property(msgspec.Struct, gc=False):
+    """
+    unset fields are missing keys, `prop["key"]`, `get`, `in`, `items` and `update` work like on the record dicts
+    (with the JSON keys, e.g. "price (per day per object)"), new fields have to be declared here, in the order
+    the stages add them so the JSON and csv columns keep their order; gc=False, records never form cycles
+    """
+    # crawled, parse_property
+    url: str
+    id: Union[str, UnsetType] = UNSET
+    name: Union[str, UnsetType] = UNSET
+    locality: Union[str, UnsetType] = UNSET
+    capacity: Union[str, UnsetType] = UNSET
+    rooms: Union[Optional[str], UnsetType] = UNSET
+    icons: Union[List[Optional[str]], UnsetType] = UNSET
+    contact_raw: Union[str, UnsetType] = UNSET
+    contact_links: Union[List[Optional[str]], UnsetType] = UNSET
+    map_link: Union[Optional[str], UnsetType] = UNSET
+    distances: Union[List[List[str]], UnsetType] = UNSET
+    equipment: Union[List[Optional[str]], UnsetType] = UNSET
+    ratings: Union[List[str], UnsetType] = UNSET
+    numeric_ratings: Union[List[Union[str, int]], UnsetType] = UNSET
+    place: Union[str, UnsetType] = UNSET
+    pricelist: Union[List[str], UnsetType] = UNSET
+    images: Union[List[List[Optional[str]]], UnsetType] = UNSET
+    # the JSON string as it was read (msgspec.Raw) or the str of a freshly parsed page
+    text: Union[msgspec.Raw, UnsetType] = UNSET
+    GPS: Union[Dict[str, str], UnsetType] = UNSET
+    # enhanced, process.ENHANCE_STAGES
+    homepage: Union[Optional[str], UnsetType] = UNSET
+    rating_stats: Union[Optional[Dict[str, Any]], UnsetType] = UNSET
+    distances_map: Union[Dict[str, str], UnsetType] = UNSET
+    # process.DISTANCE_PLACES
+    les_distance_m: Union[float, UnsetType] = UNSET
+    restaurace_distance_m: Union[float, UnsetType] = UNSET
+    obchod_distance_m: Union[float, UnsetType] = UNSET
+    price_sections: Union[List[Dict[str, Any]], UnsetType] = UNSET
+    apartman: Union[bool, UnsetType] = UNSET
+    half_board: Union[bool, UnsetType] = msgspec.field(default=UNSET, name="half-board")
+    breakfast: Union[bool, UnsetType] = UNSET
+    price: Union[int, UnsetType] = msgspec.field(default=UNSET, name="price (per day per object)")
+    features: Union[List[str], UnsetType] = UNSET
+    area: Union[str, UnsetType] = UNSET
+    # filtering and deduplication
+    filtered_reasons: Union[Set[str], UnsetType] = UNSET
+    filtered: Union[bool, UnsetType] = UNSET
+    duplicate_of: Union[str, UnsetType] = UNSET
+
+    def __getitem__(self, key: str) -> Any:
+        value = getattr(self, attribute(key))
+        if value is UNSET:
+            raise KeyError(key)
+        if isinstance(value, msgspec.Raw):
+            return msgspec.json.decode(value)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        setattr(self, attribute(key), value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in ATTRIBUTES and getattr(self, ATTRIBUTES[key]) is not UNSET
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key, name in ATTRIBUTES.items() if getattr(self, name) is not UNSET)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+    def keys(self) -> List[str]:
+        return list(self)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        """
+        the stored values, the text as it was read (msgspec.Raw) without decoding it
+        """
+        for key, name in ATTRIBUTES.items():
+            value = getattr(self, name)
+            if value is not UNSET:
+                yield key, value
+
+    def update(self, fields: Dict[str, Any]):
+        for key, value in fields.items():
+            self[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: self[key] for key in self}
+
+
+# JSON key -> attribute
+ATTRIBUTES: Dict[str, str] = dict(zip(Property.__struct_encode_fields__, Property.__struct_fields__))
+
+decoder = msgspec.json.Decoder(Property)
+encoder = msgspec.json.Encoder()
+
+
+def attribute(key: str) -> str:
+    try:
+        return ATTRIBUTES[key]
+    except KeyError:
+        raise KeyError(f"{key} is not a field of record.Property") from None
+
+
+def decode(line: Union[str, bytes]) -> Property:
+    """
+    a JSON line of a property, unknown keys are ignored and wrongly typed values raise msgspec.ValidationError
+    """
+    return decoder.decode(line)
+
+
+def encode(prop: Property) -> str:
+    # sets sorted, their iteration order changes with every interpreter
+    if prop.filtered_reasons is not UNSET:
+        prop = msgspec.structs.replace(prop, filtered_reasons=sorted(prop.filtered_reasons))
+    return encoder.encode(prop).decode("utf-8")
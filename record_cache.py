@@ -0,0 +1,76 @@
+import sqlite3
+from typing import Iterable, List, Optional, Tuple
+
+CACHE_PATH = "process-cache.sqlite"
+
+
+class RecordCache:
+    """
+    fields added by enhancing a record, keyed by the sha256 of the raw crawl record and stored in sqlite with
+    the stats the enhancement added, all records are dropped when the enhancement code `version` changes and
+    records missing in the last complete run are evicted
+    a readonly cache (used by worker processes) only collects the writes in `new` and `seen` for the main process
+    """
+
+    def __init__(self, path: str = CACHE_PATH, version: str = "", readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        self.stored = 0  # records enhanced in this run
+        self.new: List[Tuple[str, str, str]] = []
+        self.seen: List[str] = []
+        if readonly:
+            self.db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            return
+        self.db = sqlite3.connect(path)
+        # workers read while the main process writes
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS records (hash TEXT PRIMARY KEY, fields TEXT, stats TEXT, run INTEGER)")
+        stored = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if stored is None or stored[0] != version:
+            self.db.execute("DELETE FROM records")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        self.run = (self.db.execute("SELECT max(run) FROM records").fetchone()[0] or 0) + 1
+        self.db.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """
+        (enhanced fields, stats) as JSON
+        """
+        return self.db.execute("SELECT fields, stats FROM records WHERE hash = ?", (key,)).fetchone()
+
+    def put(self, entries: Iterable[Tuple[str, str, str]]):
+        """
+        store (hash, enhanced fields, stats) entries
+        """
+        if self.readonly:
+            self.new += entries
+            return
+        entries = list(entries)
+        self.db.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)",
+                            ((key, fields, stats, self.run) for key, fields, stats in entries))
+        self.stored += len(entries)
+        self.db.commit()
+
+    def mark_seen(self, keys: Iterable[str]):
+        """
+        keep records of this run's input from being evicted
+        """
+        if self.readonly:
+            self.seen += keys
+            return
+        self.db.executemany("UPDATE records SET run = ? WHERE hash = ?", ((self.run, key) for key in keys))
+        self.db.commit()
+
+    def evict(self) -> int:
+        """
+        drop the records of properties which are no longer in the crawl (or changed), call after a complete run
+        """
+        deleted = self.db.execute("DELETE FROM records WHERE run != ?", (self.run,)).rowcount
+        self.db.commit()
+        return deleted
+
+    def close(self):
+        if not self.readonly:
+            self.db.commit()
+        self.db.close()
@@ -0,0 +1,180 @@
+"""
+JSON lines files, optionally gzip/zstd compressed and sharded, the compression is given by the file extension
+"""
+import codecs
+import gzip
+import io
+import json
+import os
+import zlib
+from typing import Dict, Iterator, List, TextIO
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from journal import drop_partial_line
+
+COMPRESSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def zstd_required():
+    if zstandard is None:
+        raise RuntimeError("zstd compression requires `pip install zstandard`")
+
+
+def open_text(path: str, mode: str = "w") -> TextIO:
+    """
+    open for writing ("w") or appending ("a"), reading goes through read_shard
+    """
+    if path.endswith(".gz"):
+        # every flush ends a deflate block so a crashed crawl leaves readable complete records
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=6)
+    if path.endswith(".zst"):
+        zstd_required()
+        # unbuffered file so a flushed block reaches the disk right away
+        writer = zstandard.ZstdCompressor(level=6).stream_writer(open(path, mode + "b", buffering=0), closefd=True)
+        return io.TextIOWrapper(writer, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def zstd_chunks(path: str) -> Iterator[bytes]:
+    """
+    decompressed data of all frames, including the flushed blocks of an unfinished frame
+    (zstandard's stream_reader holds back the tail of a frame without an end mark)
+    """
+    zstd_required()
+    with open(path, "rb") as f:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        while chunk := f.read(1 << 20):
+            while chunk:
+                yield decompressor.decompress(chunk)
+                chunk = b""
+                if decompressor.eof:
+                    # shards appended to by a resumed crawl consist of several frames
+                    chunk = decompressor.unused_data
+                    decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+
+def shard_paths(path: str) -> List[str]:
+    """
+    files of a (possibly sharded) output, `path` is a single file or a manifest
+    """
+    if not path.endswith(MANIFEST_SUFFIX):
+        return [path]
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    root = os.path.dirname(path)
+    return [os.path.join(root, shard["path"]) for shard in manifest["shards"]]
+
+
+def read_shard(path: str) -> Iterator[str]:
+    if path.endswith(".zst"):
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        pending = ""
+        try:
+            for chunk in zstd_chunks(path):
+                *lines, pending = (pending + decoder.decode(chunk)).split("\n")
+                for line in lines:
+                    yield line + "\n"
+        except zstandard.ZstdError:
+            return
+        if pending:
+            yield pending
+        return
+    with gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, encoding="utf-8") as f:
+        try:
+            yield from f
+        except (EOFError, zlib.error):
+            # output of a crawl which is still running or was killed, the torn last record is dropped
+            return
+
+
+def read_lines(path: str) -> Iterator[str]:
+    for shard in shard_paths(path):
+        for line in read_shard(shard):
+            if line.endswith("\n"):
+                yield line
+
+
+def repair(path: str) -> int:
+    """
+    make an interrupted output appendable again by dropping its torn last record, returns the number of records
+    """
+    if not os.path.exists(path):
+        return 0
+    if not path.endswith((".gz", ".zst")):
+        drop_partial_line(path)
+        with open(path, encoding="utf-8") as f:
+            return sum(1 for _ in f)
+    records = 0
+    tmp_path = f"{path}.tmp{os.path.splitext(path)[1]}"
+    with open_text(tmp_path, "w") as out:
+        for line in read_lines(path):
+            out.write(line)
+            records += 1
+    os.replace(tmp_path, path)
+    return records
+
+
+def output_paths(base: str, compression: str = "gzip", shards: int = 1) -> List[str]:
+    extension = COMPRESSIONS[compression]
+    if shards > 1:
+        return [f"{base}.{i:05d}-of-{shards:05d}{extension}" for i in range(shards)]
+    return [base + extension]
+
+
+class ShardedWriter:
+    """
+    file-like writer spreading JSON lines round-robin over `shards` files, described by a manifest
+    written on close (a single shard is written to `<base><extension>` without a manifest)
+    """
+
+    def __init__(self, base: str, compression: str = "gzip", shards: int = 1, append: bool = False):
+        self.compression = compression
+        self.manifest = base + MANIFEST_SUFFIX if shards > 1 else None
+        self.paths = output_paths(base, compression, shards)
+        self.records = [repair(path) if append else 0 for path in self.paths]
+        self.files = [open_text(path, "a" if append else "w") for path in self.paths]
+        self.next = 0
+        self.dirty = set()
+        self.write_manifest()
+
+    @property
+    def path(self) -> str:
+        return self.manifest or self.paths[0]
+
+    def write(self, line: str):
+        self.files[self.next].write(line)
+        self.records[self.next] += 1
+        self.dirty.add(self.next)
+        self.next = (self.next + 1) % len(self.files)
+
+    def flush(self):
+        # flushing an unchanged compressed stream would still emit an empty block
+        for i in self.dirty:
+            self.files[i].flush()
+        self.dirty.clear()
+
+    def write_manifest(self):
+        if self.manifest:
+            manifest: Dict = {
+                "compression": self.compression,
+                "shards": [{"path": os.path.basename(path), "records": records}
+                           for path, records in zip(self.paths, self.records)],
+            }
+            with open(self.manifest, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.write_manifest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,93 @@
+"""
+synthetic crawl output for benchmarks: fixture_server properties rendered to html and parsed like a crawl,
+optionally with their pages stored in an html cache for the parser benchmark
+"""
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterator, List, Optional, Tuple
+
+from fixture_server import fake_property, property_url, render_property, render_review_page, review_pages
+from html_cache import HtmlCache
+from page_parser import DEFAULT_BACKEND, LexborHTMLParser, parse_line
+from storage import open_text
+from utils import bounded_map
+
+BASE_URL = "http://127.0.0.1:8000"
+SCALES = {"1k": 1000, "10k": 10000, "100k": 100000, "1m": 1000000}
+# properties generated by a worker at once
+CHUNK_SIZE = 500
+# the fastest parser, the records are the same with every backend
+BACKEND = "selectolax" if LexborHTMLParser is not None else DEFAULT_BACKEND
+
+# (url, html) of a property page and its review pages
+Pages = List[Tuple[str, str]]
+
+
+def property_pages(index: int, base_url: str = BASE_URL) -> Pages:
+    prop = fake_property(index)
+    url = property_url(base_url, prop)
+    pages = [(url, render_property(base_url, prop))]
+    if review_pages(prop) > 1:
+        pages += [(f"{url}?recenze={page}", render_review_page(base_url, prop, page))
+                  for page in range(1, review_pages(prop) + 1)]
+    return pages
+
+
+def generate_chunk(start: int, stop: int, base_url: str, with_pages: bool) -> Tuple[List[str], List[Pages]]:
+    """
+    JSON lines of the properties start..stop (and their pages), parsed with all reviews like a crawl
+    """
+    lines, chunk_pages = [], []
+    for index in range(start, stop):
+        pages = property_pages(index, base_url)
+        (url, html), reviews = pages[0], [html for _, html in pages[1:]]
+        lines.append(parse_line(url, html, BACKEND, reviews))
+        if with_pages:
+            chunk_pages.append(pages)
+    return lines, chunk_pages
+
+
+def generate(path: str, count: int, workers: int = 1, base_url: str = BASE_URL,
+             cache: Optional[HtmlCache] = None) -> Iterator[int]:
+    """
+    write `count` synthetic records to `path` (compressed by extension), yields the number written so far
+    """
+    chunks = ((start, min(start + CHUNK_SIZE, count), base_url, cache is not None)
+              for start in range(0, count, CHUNK_SIZE))
+    written = 0
+    with open_text(path, "w") as f, ProcessPoolExecutor(max(1, workers)) as pool:
+        for lines, chunk_pages in bounded_map(pool, generate_chunk, chunks, max(1, workers) * 2):
+            f.writelines(lines)
+            for pages in chunk_pages:
+                for url, html in pages:
+                    cache.put(url, html.encode("utf-8"))
+            written += len(lines)
+            yield written
+
+
+def scale(value: str) -> int:
+    return SCALES[value.lower()] if value.lower() in SCALES else int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate a synthetic properties.json.gz of fixture properties")
+    parser.add_argument("--count", type=scale, default=SCALES["10k"],
+                        help=f"number of properties or a scale ({', '.join(SCALES)})")
+    parser.add_argument("--output", default="synthetic-properties.json.gz", help="JSON lines (.gz/.zst compressed)")
+    parser.add_argument("--html", metavar="CACHE_DIR", help="also store the pages in an html cache")
+    parser.add_argument("--workers", type=int, default=1, help="generating processes")
+    args = parser.parse_args()
+
+    cache = HtmlCache(args.html) if args.html else None
+    start = time.monotonic()
+    for written in generate(args.output, args.count, args.workers, cache=cache):
+        if written % 10000 < CHUNK_SIZE or written == args.count:
+            print(f"{written}/{args.count} properties, {written / (time.monotonic() - start):.0f}/s", flush=True)
+    if cache:
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+the fixture site and the mock ollama server as pytest fixtures, the scripts run in a temporary working directory
+like they would in the repo (journal, html cache and outputs at their default relative paths)
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def serve(script: str, *args: str, port: int = None):
+    """
+    run a server script of the repo on `port` (a free one by default) until the block ends, yields its base url
+    """
+    port = port or free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, script), "--port", str(port), *args],
+                              stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"{script} did not start")
+                time.sleep(0.05)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run(script: str, *args: str, cwd: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, os.path.join(ROOT, script), *args], cwd=cwd, check=True,
+                          capture_output=True, text=True)
+
+
+@pytest.fixture
+def site():
+    # one listing per region keeps a crawl to a few hundred requests
+    with serve("fixture_server.py", "--latency", "0", "--per-region", "1") as url:
+        yield url
@@ -0,0 +1,113 @@
+"""
+crawls of fixture_server.py: resume, incremental re-crawl and replay of the html cache
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import ROOT, free_port, run, serve
+
+pytest.importorskip("aiohttp")
+
+from fixture_server import edited  # noqa: E402
+
+EDITED_FRACTION = 0.3
+
+
+def crawl(base_url: str, cwd: str, *args: str) -> subprocess.CompletedProcess:
+    return run("download.py", "--concurrency", "4", "--rps", "1000", "--base-url", base_url, "--output", "props.json",
+               "--compression", "none", *args, cwd=cwd)
+
+
+def lines(path: str):
+    with open(path, encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+def journal(path: str):
+    """
+    the entries of the last crawl in a journal
+    """
+    entries = []
+    for line in lines(os.path.join(path, "crawl-journal.jsonl")):
+        entry = json.loads(line)
+        if "crawl" in entry:
+            entries = []
+        entries.append(entry)
+    return entries
+
+
+def pages_done(path: str) -> int:
+    if not os.path.exists(os.path.join(path, "crawl-journal.jsonl")):
+        return 0
+    return sum("url" in entry for entry in journal(path))
+
+
+def counters(path: str):
+    with open(os.path.join(path, "metrics", "crawl.json")) as f:
+        return json.load(f)["counters"]
+
+
+def test_resume_after_interruption(tmp_path):
+    full, resumed = tmp_path / "full", tmp_path / "resumed"
+    full.mkdir()
+    resumed.mkdir()
+    with serve("fixture_server.py", "--latency", "0.02", "--per-region", "1") as url:
+        crawl(url, str(full))
+        crawler = subprocess.Popen([sys.executable, os.path.join(ROOT, "download.py"), "--concurrency", "2",
+                                    "--base-url", url, "--output", "props.json", "--compression", "none"],
+                                   cwd=resumed, stderr=subprocess.DEVNULL)
+        # killed with some pages done, like a crash, the pages in flight are lost
+        while crawler.poll() is None and pages_done(str(resumed)) < 20:
+            time.sleep(0.05)
+        crawler.send_signal(signal.SIGKILL)
+        crawler.wait()
+        interrupted = lines(resumed / "props.json")
+        assert 0 < len(interrupted) < len(lines(full / "props.json"))
+        crawl(url, str(resumed), "--resume")
+
+    records = lines(resumed / "props.json")
+    assert records[:len(interrupted)] == interrupted
+    assert sorted(records) == sorted(lines(full / "props.json"))
+
+
+def test_incremental_unchanged_pages(tmp_path):
+    # the next revision of the site on the same port, the journal knows the pages by url
+    port = free_port()
+    with serve("fixture_server.py", "--latency", "0", "--per-region", "1", port=port) as url:
+        crawl(url, str(tmp_path))
+    previous = {json.loads(line)["url"]: line for line in lines(tmp_path / "props.json")}
+    full_bytes = counters(str(tmp_path))["fetched_bytes"]
+    os.replace(tmp_path / "props.json", tmp_path / "previous.json")
+
+    with serve("fixture_server.py", "--latency", "0", "--per-region", "1", "--revision", "1",
+               "--edited-fraction", str(EDITED_FRACTION), port=port) as url:
+        crawl(url, str(tmp_path), "--incremental", "previous.json")
+
+    changed = {u for u in previous if edited(int(u.rsplit("-", 1)[1][:-len(".php")]), 1, EDITED_FRACTION)}
+    assert 0 < len(changed) < len(previous)
+    entries = journal(str(tmp_path))
+    assert {e["url"] for e in entries if "url" in e and not e["changed"]} == set(previous) - changed
+    assert {e["carried"] for e in entries if "carried" in e} == set(previous) - changed
+    records = {json.loads(line)["url"]: line for line in lines(tmp_path / "props.json")}
+    assert records.keys() == previous.keys()
+    for u, line in records.items():
+        if u in changed:
+            assert "(upraveno 1)" in json.loads(line)["text"]
+        else:
+            assert line == previous[u]
+    # the unchanged pages come back as 304 without a body and their review pages are not fetched
+    assert counters(str(tmp_path))["fetched_bytes"] < full_bytes * (EDITED_FRACTION + 0.2)
+
+
+def test_replay_parity(tmp_path, site):
+    crawl(site, str(tmp_path))
+    run("download.py", "--replay", "--output", "replayed.json", "--compression", "none", cwd=str(tmp_path))
+    replayed = lines(tmp_path / "replayed.json")
+    assert replayed
+    assert sorted(replayed) == sorted(lines(tmp_path / "props.json"))
@@ -0,0 +1,70 @@
+"""
+the ratings store and rank.py against mock_ollama.py
+"""
+import asyncio
+import json
+
+import pytest
+
+from conftest import serve
+from ratings_store import RatingsStore, rater_id
+
+PROPERTIES = 8
+
+
+def fake_properties():
+    # the fields format_property reads
+    return [{"id": f"objekt č. {i}", "url": f"http://127.0.0.1/chalupa-{i}.php", "name": f"Chalupa {i}",
+             "capacity": str(20 + i), "rooms": str(5 + i), "icons": ["Wi-Fi zdarma"], "equipment": ["Krb"],
+             "text": f"menu kontakty  mapa Chalupa {i} v lese. Kontakt na pronajímatele nebo provozovatele",
+             "ratings": [f"Jaro 2024 hezké {i}"], "images": []} for i in range(PROPERTIES)]
+
+
+def test_export_order(tmp_path):
+    store = RatingsStore(str(tmp_path / "ratings.sqlite"), None)
+    store.put("b", "gemma2_v3", {"rating": 0.5})
+    store.put("a", "gemma2_v3", {"rating": 0.7})
+    store.put("b", "mhalik", 3)
+    # rated again, keeps its place
+    store.put("b", "gemma2_v3", {"rating": 0.6})
+    store.compact()
+    store.close()
+
+    store = RatingsStore(str(tmp_path / "ratings.sqlite"), None)
+    store.export(str(tmp_path / "ratings.json"))
+    store.close()
+    with open(tmp_path / "ratings.json") as f:
+        exported = json.load(f)
+    assert list(exported) == ["b", "a"]
+    assert list(exported["b"].items()) == [("gemma2_v3", {"rating": 0.6}), ("mhalik", 3)]
+
+
+def test_retry_queue_drained(tmp_path, monkeypatch):
+    pytest.importorskip("ollama")
+    import rank
+
+    monkeypatch.setattr(rank, "RETRY_ROUNDS", 0)
+    properties = fake_properties()
+    references = {"first": properties[0], "second": properties[1]}
+    rater = rater_id("gemma2", "v3")
+    store = RatingsStore(str(tmp_path / "ratings.sqlite"), None)
+
+    # every generated rating is out of range, all of them wait for a retry
+    with serve("mock_ollama.py", "--latency", "0.05", "--slots", "2", "--failure-rate", "1") as url:
+        asyncio.run(rank.sweep(properties, store, references, ["gemma2"], ["v3"], 4, 10, url))
+    assert len(store) == 0
+    assert store.retries(rater) == {p["id"]: 1 for p in properties}
+
+    # the queued ratings are generated in the first retry round of the next run
+    monkeypatch.setattr(rank, "RETRY_ROUNDS", 1)
+    monkeypatch.setattr(rank, "RETRY_BACKOFF", 0)
+    with serve("mock_ollama.py", "--latency", "0.05", "--slots", "2") as url:
+        asyncio.run(rank.sweep(properties, store, references, ["gemma2"], ["v3"], 4, 10, url))
+    assert store.retries(rater) == {}
+    store.export(str(tmp_path / "ratings.json"))
+    store.close()
+    with open(tmp_path / "ratings.json") as f:
+        exported = json.load(f)
+    # generated by 4 requests in flight, put in the order of the properties
+    assert list(exported) == [p["id"] for p in properties]
+    assert all(0 <= ratings[rater]["rating"] <= 1 for ratings in exported.values())
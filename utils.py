@@ -1,7 +1,161 @@
+import math
 import statistics
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+# t-digest compression, higher keeps more centroids and gives more precise percentiles
+COMPRESSION = 200
+
+
+class TDigest:
+    """
+    mergeable sketch of a distribution, a sorted list of (mean, weight) centroids, small near both tails
+    """
+
+    def __init__(self, compression: int = COMPRESSION):
+        self.compression = compression
+        self.centroids: List[Tuple[float, float]] = []
+        self.buffer: List[Tuple[float, float]] = []
+
+    def add(self, value: float, weight: float = 1):
+        self.buffer.append((value, weight))
+        if len(self.buffer) > 10 * self.compression:
+            self.compress()
+
+    def merge(self, other: "TDigest"):
+        self.buffer += other.centroids + other.buffer
+        self.compress()
+
+    def compress(self):
+        points = sorted(self.centroids + self.buffer)
+        self.buffer = []
+        total = math.fsum(w for _, w in points)
+        merged = []
+        before = 0.0
+        mean, weight = points[0] if points else (0.0, 0.0)
+        for value, w in points[1:]:
+            q = (before + (weight + w) / 2) / total
+            if weight + w <= max(1.0, 4 * total * q * (1 - q) / self.compression):
+                mean += (value - mean) * w / (weight + w)
+                weight += w
+            else:
+                merged.append((mean, weight))
+                before += weight
+                mean, weight = value, w
+        if points:
+            merged.append((mean, weight))
+        self.centroids = merged
+
+    def quantile(self, q: float, low: float, high: float) -> float:
+        """
+        interpolated between centroid centres, `low` and `high` are the exact extremes
+        """
+        self.compress()
+        total = math.fsum(w for _, w in self.centroids)
+        position = q * total
+        previous_value, previous_position = low, 0.0
+        cumulative = 0.0
+        for value, weight in self.centroids:
+            centre = cumulative + weight / 2
+            if position < centre:
+                span = centre - previous_position
+                fraction = (position - previous_position) / span if span else 0.0
+                return previous_value + (value - previous_value) * fraction
+            previous_value, previous_position = value, centre
+            cumulative += weight
+        span = total - previous_position
+        fraction = (position - previous_position) / span if span else 0.0
+        return previous_value + (high - previous_value) * fraction
+
+
+class StreamingStats:
+    """
+    summary statistics updated one value at a time in O(1) memory and mergeable across workers: count/min/max
+    exact, mean and variance by Welford's update (Chan's formula to merge), the median and percentiles from a
+    t-digest, exact while every value is its own centroid (a few hundred values) and approximate above
+    """
+
+    def __init__(self, compression: int = COMPRESSION):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.ints = True
+        self.mean_value = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+        self.digest = TDigest(compression)
+
+    def add(self, value):
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.ints = self.ints and isinstance(value, int)
+        delta = value - self.mean_value
+        self.mean_value += delta / self.count
+        self.m2 += delta * (value - self.mean_value)
+        self.digest.add(value)
+
+    def update(self, values: Iterable):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other: "StreamingStats") -> "StreamingStats":
+        """
+        add the values of `other`
+        """
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean_value - self.mean_value
+        self.mean_value += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self.ints = self.ints and other.ints
+        self.digest.merge(other.digest)
+        return self
+
+    def mean(self):
+        # like statistics.mean the mean of integers stays an integer when it is whole
+        if self.ints and self.mean_value.is_integer():
+            return int(self.mean_value)
+        return self.mean_value
+
+    def stdev(self) -> float:
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def quantile(self, q: float):
+        return self.digest.quantile(q, self.min, self.max)
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def stats(self) -> Dict:
+        if not self.count:
+            raise ValueError("no samples")
+        stats = {
+            "max": self.max,
+            "min": self.min,
+            "mean": self.mean(),
+            "median": self.median(),
+
+            "samples": self.count
+        }
+        if stats["samples"] > 1:
+            stats["stdev"] = self.stdev()
+        stats["max_diff"] = stats["max"] - stats["min"]
+        return stats
 
 
 def numeric_stats(data):
+    """
+    stats of values already in a list (e.g. the reviews of one property), exact like the statistics module
+    """
     stats = {
         "max": max(data),
         "min": min(data),
@@ -14,3 +168,16 @@ def numeric_stats(data):
         stats["stdev"] = statistics.stdev(data)
     stats["max_diff"] = stats["max"] - stats["min"]
     return stats
+
+
+def bounded_map(executor: Executor, fn: Callable, arguments: Iterable[Tuple], window: int) -> Iterator:
+    """
+    ordered executor.map keeping at most `window` tasks in flight, so the input is never queued up at once
+    """
+    pending = deque()
+    for args in arguments:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, *args))
+    while pending:
+        yield pending.popleft().result()